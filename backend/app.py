@@ -1,35 +1,267 @@
+import json
 import os
-import hashlib
+import time
 from waitress import serve
-from flask import Flask, render_template, jsonify, request, url_for
+from flask import Flask, Request, Response, abort, g, render_template, \
+    jsonify, request, url_for
 from flask_cors import CORS
 
 from cv import image_compute
+from expr import Budget
+from lru import MISSING
+from resultcache import ResultCache
+import jobs
+import metrics
+import storage
+import tracing
+
+# Largest upload accepted, in bytes, and largest batch of them.
+# Requests that say they are bigger are refused before any of
+# the body is read.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 16 * 1024 * 1024))
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 64 * 1024 * 1024))
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 100))
+# Leave room for the multipart headers around the files
+UPLOAD_OVERHEAD = 64 * 1024
+
+class LimitedRequest(Request):
+    """Request whose body may be no bigger than its route allows,
+    so only /batch may send a batch's worth
+    """
+
+    @property
+    def max_content_length(self):
+        limit = MAX_BATCH_BYTES if self.endpoint == 'batch' \
+            else MAX_UPLOAD_BYTES
+        return limit + UPLOAD_OVERHEAD
+
+class CappedInput(object):
+    """Reads a body of unknown length, aborting with 413 as soon
+    as it passes limit bytes
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.seen = 0
+
+    def read(self, size=-1):
+        return self._count(self.stream.read(self._size(size)))
+
+    def readline(self, size=-1):
+        return self._count(self.stream.readline(self._size(size)))
+
+    def _size(self, size):
+        # Never ask for more than one byte past the limit
+        room = self.limit - self.seen + 1
+        return room if size is None or size < 0 else min(size, room)
+
+    def _count(self, data):
+        self.seen += len(data)
+        if self.seen > self.limit:
+            abort(413)
+        return data
 
 app = Flask(__name__)
+app.request_class = LimitedRequest
 CORS(app)
 
+REQUESTS = metrics.Counter(
+    "http_requests_total", "Requests handled, by route and status",
+    labels=("route", "status"))
+REQUEST_SECONDS = metrics.Histogram(
+    "http_request_seconds", "Time taken to handle each request, by route",
+    labels=("route",))
+
+# Results by file hash, so repeated GETs don't recompute them.
+# Set RESULT_CACHE_DIR to keep them across restarts.
+RESULTS = ResultCache(
+    capacity=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+    directory=os.environ.get('RESULT_CACHE_DIR'))
+metrics.register_cache("result", RESULTS.stats)
+
+# Results are computed in the background: uploads and batches
+# queue a job, and GETs report on it until the result is ready.
+JOBS = jobs.JobQueue(
+    lambda key, path: RESULTS.get(key, lambda: compute_result(path)),
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_queued=int(os.environ.get('JOB_QUEUE_SIZE', 64)))
+# A failed job is tried again by the first GET this many seconds
+# after it failed, in case the failure was only passing.
+RETRY_FAILED_AFTER = float(os.environ.get('JOB_RETRY_SECONDS', 10))
+
+# Limits on evaluating each expression: operations computed,
+# and CPU seconds spent on them
+BUDGET = Budget(
+    max_steps=int(os.environ.get('EVAL_MAX_STEPS', 100000)),
+    max_seconds=float(os.environ.get('EVAL_MAX_SECONDS', 1.0)))
+
+def busy():
+    """Response telling the client to retry when the queue has room"""
+    return Response('Busy, try again later', status=503,
+                    headers={'Retry-After': '5'})
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.before_request
+def cap_body():
+    # Werkzeug only checks a Content-Length the client declares,
+    # so a chunked body is cut off here instead
+    if request.content_length is None and 'wsgi.input' in request.environ:
+        request.environ['wsgi.input'] = CappedInput(
+            request.environ['wsgi.input'], request.max_content_length)
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.inc(route=route, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, route=route)
+    return response
+
+@app.route('/metrics', methods = ['GET'])
+def metrics_text():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/uploader', methods = ['GET', 'POST'])
 def uploader():
     if request.method == 'POST':
-        f = request.files['file']
-        filename, file_extension = os.path.splitext(f.filename)
-        hashed_filename = hashlib.sha256(filename.encode()).hexdigest()[:15]
-        f.save(os.environ['UPLOAD_FOLDER'] + hashed_filename)
-        print('[POST]\tRecieved: {}'.format(hashed_filename))
-        return hashed_filename
+        if (request.content_length or 0) > MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD:
+            abort(413)
+        if request.mimetype == 'application/octet-stream':
+            # The image is the whole body: copy it straight from
+            # the connection
+            stream = request.stream
+        else:
+            # Werkzeug spools large files to disk while parsing
+            # the form, so this doesn't hold the file in memory
+            stream = request.files['file'].stream
+        with metrics.stage('upload_save'):
+            try:
+                stored = storage.save(stream, os.environ['UPLOAD_FOLDER'],
+                                      max_size=MAX_UPLOAD_BYTES)
+            except storage.TooLarge:
+                abort(413)
+        if stored.duplicate:
+            # Same content as an earlier upload, so its result
+            # (cached or not) is reused
+            print('[POST]\tRecieved: {} (duplicate)'.format(stored.key))
+        else:
+            # Drop any result left on disk from a file since removed
+            RESULTS.invalidate(stored.key)
+            print('[POST]\tRecieved: {}'.format(stored.key))
+        if RESULTS.lookup(stored.key) is MISSING:
+            try:
+                JOBS.submit(stored.key, stored.path)
+            except jobs.QueueFull:
+                return busy()
+        return stored.key
     else:
         return 'None'
 
+@app.route('/batch', methods = ['POST'])
+def batch():
+    """Store every 'file' in the request and queue jobs for
+    their results, streaming one line of JSON per file in the
+    order given: its index in the request, its filename, and its
+    hash and result, or an error.  Busy, queueing nothing, if
+    the job queue hasn't room for them all.
+    """
+    if (request.content_length or 0) > MAX_BATCH_BYTES + UPLOAD_OVERHEAD:
+        abort(413)
+    files = request.files.getlist('file')
+    if not files:
+        abort(400)
+    if len(files) > MAX_BATCH_FILES:
+        abort(413)
+    # Store them all before responding, while the body can still
+    # be read
+    stored = []
+    for f in files:
+        try:
+            with metrics.stage('upload_save'):
+                stored.append(storage.save(
+                    f.stream, os.environ['UPLOAD_FOLDER'],
+                    max_size=MAX_UPLOAD_BYTES))
+        except storage.TooLarge as e:
+            stored.append(e)
+    print('[POST]\tRecieved batch of {}'.format(len(stored)))
+    cached, todo = {}, []
+    for item in stored:
+        if not isinstance(item, Exception):
+            result = RESULTS.lookup(item.key)
+            if result is MISSING:
+                todo.append((item.key, (item.path,)))
+            else:
+                cached[item.key] = result
+    try:
+        queued = {job.key: job for job in JOBS.submit_many(todo)}
+    except jobs.QueueFull:
+        return busy()
+
+    def lines():
+        for index, (f, item) in enumerate(zip(files, stored)):
+            line = {'index': index, 'file': f.filename}
+            if isinstance(item, Exception):
+                line['error'] = str(item)
+                yield json.dumps(line) + '\n'
+                continue
+            line['hash'] = item.key
+            job = queued.get(item.key)
+            if job is None:
+                line['result'] = cached[item.key]
+            else:
+                job.wait()
+                if job.status == jobs.DONE:
+                    line['result'] = job.result
+                else:
+                    line['error'] = job.error
+            yield json.dumps(line) + '\n'
+
+    return Response(lines(), mimetype='application/x-ndjson')
+
 @app.route('/<filehash>', methods = ['GET'])
 def results(filehash):
-    if os.path.exists(os.environ['UPLOAD_FOLDER'] + filehash):
-        image = open(os.environ['UPLOAD_FOLDER'] + filehash)
-        result = image_compute(image)
-        return result
+    path = storage.lookup(os.environ['UPLOAD_FOLDER'], filehash)
+    if path:
+        if request.args.get('trace'):
+            # Trace just this request, for debugging.  Always
+            # recomputed, since a cached result has no trace.
+            with tracing.capture() as events:
+                try:
+                    outcome = {'result': compute_result(path)}
+                except Exception as e:
+                    outcome = {'error': f'{type(e).__name__}: {e}'}
+            return jsonify(trace=[event.as_dict() for event in events],
+                           **outcome)
+        result = RESULTS.lookup(filehash)
+        if result is not MISSING:
+            return result
+        job = JOBS.get(filehash)
+        if job is None or job.status == jobs.FAILED and \
+                time.monotonic() - job.finished_at >= RETRY_FAILED_AFTER:
+            # Stored before a restart, or its job long forgotten,
+            # or failed a while ago
+            try:
+                job = JOBS.submit(filehash, path)
+            except jobs.QueueFull:
+                return busy()
+        if job.status == jobs.DONE:
+            return job.result
+        # Still to come, or failed: say which
+        status = 500 if job.status == jobs.FAILED else 202
+        return jsonify(job.as_dict()), status
     else:
         return 'None'
 
+def compute_result(path):
+    with metrics.stage('image_load'):
+        image = open(path)
+    with image:
+        return image_compute(image, BUDGET)
+
 if __name__ == "__main__":
     print('Backend application is live')
     serve(app, host='0.0.0.0', port=3000)
@@ -0,0 +1,279 @@
+"""
+Microbenchmarks for the calculator.
+
+Times each stage separately over a fixed corpus of statements:
+tokenising, parsing, evaluating, solving, the whole of calc(),
+and, when Flask is installed, the web endpoints through Flask's
+test client.  Results are written as JSON, in microseconds per
+statement (or per request), e.g.
+
+    python bench.py --save-baseline baseline.json
+    ... change something ...
+    python bench.py --baseline baseline.json
+
+The second run exits with status 1 if any stage got slower than
+the baseline by more than --threshold (25% by default).  The best
+of several repeats is compared, since it is the figure least
+disturbed by whatever else the machine is doing.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import expr
+import lex
+import llcalc
+
+# Expressions evaluated with the variables in VARIABLES.
+EXPRESSIONS = [
+    "1 + 2",
+    "2 + 4 * 3 - 8 / 2",
+    "(3 * 5) / x",
+    "a * a + b * b - c",
+    "((a + b) * (a - b)) / (c + 1)",
+    "16 | 2 + 27 | 3",
+    "x ^ 3 - 3 * x ^ 2 + 3 * x - 1",
+    "(a + 1) * (b + 2) * (c + 3) * (x + 4) # a comment",
+    " + ".join(f"{i} * x" for i in range(1, 41)),
+    "(" * 30 + "a" + " + 1)" * 30,
+]
+
+# Equations solved for their variable.
+EQUATIONS = [
+    "2 + 4 = x",
+    "y * 3 - 7 = 20",
+    "3 * y + 4 = 2 * y - 1",
+    "(y + 1) ^ 2 = 49",
+    "10 / (y - 2) = 5",
+    "2 * (y + 3) - y = 4 * y + 12",
+    "y | 3 + 2 = 5",
+    " + ".join(f"{i} * y" for i in range(1, 21)) + " = 420",
+]
+
+VARIABLES = {"a": 3, "b": 4, "c": 5, "x": 2}
+
+# A stand-in image for the upload endpoint.
+IMAGE = bytes(range(256)) * 64
+
+# Each stage's setup returns a function that runs the stage once
+# over its inputs, and the number of operations in one run.
+Stage = Tuple[Callable[[], object], int]
+
+
+def _context() -> expr.Context:
+    return expr.Context({name: expr.Const(value)
+                         for name, value in VARIABLES.items()})
+
+
+def _parse(text: str) -> expr.Expr:
+    return llcalc.parse(io.StringIO(text))
+
+
+def setup_lex() -> Stage:
+    texts = EXPRESSIONS + EQUATIONS
+
+    def run():
+        for text in texts:
+            for _ in lex.iter_tokens(text):
+                pass
+    return run, len(texts)
+
+
+def setup_parse() -> Stage:
+    texts = EXPRESSIONS + EQUATIONS
+
+    def run():
+        for text in texts:
+            _parse(text)
+    return run, len(texts)
+
+
+def setup_eval() -> Stage:
+    trees = [_parse(text) for text in EXPRESSIONS]
+    ctx = _context()
+
+    def run():
+        for tree in trees:
+            tree.eval(ctx)
+    return run, len(trees)
+
+
+def setup_solve() -> Stage:
+    # Solutions are cached by structure, so clear the cache to
+    # time the solving rather than the lookup.
+    trees = [_parse(text) for text in EQUATIONS]
+
+    def run():
+        expr.SOLUTION_CACHE.clear()
+        for tree in trees:
+            tree.solved()
+    return run, len(trees)
+
+
+def setup_calc() -> Stage:
+    # Cold caches, so every statement is lexed, parsed,
+    # simplified, solved and evaluated.
+    texts = EXPRESSIONS + EQUATIONS
+
+    def run():
+        llcalc.PARSE_CACHE.clear()
+        expr.SOLUTION_CACHE.clear()
+        ctx = _context()
+        for text in texts:
+            llcalc.calc(text, ctx)
+    return run, len(texts)
+
+
+def _client():
+    """A Flask test client for the app, with uploads going to a
+    temporary folder, or None if Flask isn't installed.
+    """
+    os.environ.setdefault("UPLOAD_FOLDER",
+                          tempfile.mkdtemp(prefix="bench-") + os.sep)
+    try:
+        import app
+    except ImportError:
+        return None
+    return app.app.test_client()
+
+
+def setup_http_upload() -> Optional[Stage]:
+    client = _client()
+    if client is None:
+        return None
+
+    def run():
+        client.post("/uploader", data={
+            "file": (io.BytesIO(IMAGE), "bench.png")})
+    return run, 1
+
+
+def setup_http_result() -> Optional[Stage]:
+    client = _client()
+    if client is None:
+        return None
+    filehash = client.post("/uploader", data={
+        "file": (io.BytesIO(IMAGE), "bench.png")}).get_data(as_text=True)
+
+    def run():
+        client.get(f"/{filehash}")
+    return run, 1
+
+
+STAGES: Dict[str, Callable[[], Optional[Stage]]] = OrderedDict([
+    ("lex", setup_lex),
+    ("parse", setup_parse),
+    ("eval", setup_eval),
+    ("solve", setup_solve),
+    ("calc", setup_calc),
+    ("http_upload", setup_http_upload),
+    ("http_result", setup_http_result),
+])
+
+
+def measure(run: Callable[[], object], ops: int, repeat: int = 5,
+            min_time: float = 0.05) -> Dict[str, float]:
+    """Time run() repeat times, each time looping it for at least
+    min_time seconds, and return the best and median time per
+    operation in microseconds.
+    """
+    run()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        if time.perf_counter() - start >= min_time:
+            break
+        loops *= 2
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        times.append((time.perf_counter() - start) / (loops * ops) * 1e6)
+    return {"best_us": min(times),
+            "median_us": statistics.median(times),
+            "ops": ops * loops}
+
+
+def run_benchmarks(stages: List[str] = None, repeat: int = 5,
+                   min_time: float = 0.05) -> Dict[str, object]:
+    """Benchmark the named stages (by default all of them).
+    Stages that can't run here are listed as skipped.
+    """
+    results = OrderedDict()
+    skipped = []
+    for name in stages or STAGES:
+        stage = STAGES[name]()
+        if stage is None:
+            skipped.append(name)
+            continue
+        results[name] = measure(*stage, repeat=repeat, min_time=min_time)
+    return {"python": platform.python_version(),
+            "stages": results,
+            "skipped": skipped}
+
+
+def compare(results: Dict[str, object], baseline: Dict[str, object],
+            threshold: float = 0.25) -> List[Tuple[str, float, float]]:
+    """The stages whose best time is worse than the baseline's by
+    more than the fraction threshold, as (stage, baseline, now).
+    Stages missing from either run are not compared.
+    """
+    regressions = []
+    for name, now in results["stages"].items():
+        before = baseline["stages"].get(name)
+        if before and now["best_us"] > before["best_us"] * (1 + threshold):
+            regressions.append((name, before["best_us"], now["best_us"]))
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks for the calculator.")
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help="stages to run: " + ", ".join(STAGES)
+                             + " (default: all)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed repeats per stage")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="minimum seconds per repeat")
+    parser.add_argument("--baseline", type=argparse.FileType("r"),
+                        help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown, as a fraction")
+    parser.add_argument("--save-baseline", type=argparse.FileType("w"),
+                        help="also write the results to this file")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage {unknown[0]}")
+
+    results = run_benchmarks(args.stages, args.repeat, args.min_time)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if args.save_baseline:
+        json.dump(results, args.save_baseline, indent=2)
+        args.save_baseline.close()
+    if args.baseline:
+        regressions = compare(results, json.load(args.baseline),
+                              args.threshold)
+        for name, before, now in regressions:
+            print(f"{name}: {before:.2f}us -> {now:.2f}us "
+                  f"({now / before - 1:+.0%})", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Compact binary encoding of expression trees.
+
+An encoded tree can be stored or sent to another process and
+turned back into the same Expr without lexing and parsing its
+text again.  The layout is
+
+    magic    b"EXP" and a version byte
+    names    varint count, then each variable name as a varint
+             byte length and its UTF-8 bytes
+    body     the nodes in prefix order (each node before its
+             children, left before right), each one opcode byte
+             and, for leaves, a payload:
+               INT      zigzag varint, of any size
+               FLOAT    8 byte little-endian double
+               COMPLEX  two doubles, real then imaginary
+               VAR      varint index into names
+
+Both directions use explicit stacks, so trees of any depth can
+be encoded and decoded.  decode() takes any bytes-like object,
+including a memoryview of an mmap.
+"""
+import struct
+from typing import List, Union
+
+from expr import (Abs, BinOp, Const, Div, Equals, Expr, Minus, Neg, Plus,
+                  Raise, Root, Times, Var)
+
+MAGIC = b"EXP"
+VERSION = 1
+
+INT, FLOAT, COMPLEX, VAR = range(4)
+
+# Opcodes of the operator nodes follow the leaf opcodes.  Only
+# ever append to this list: the position is the opcode.
+OPERATORS = [Plus, Minus, Times, Div, Raise, Root, Abs, Neg, Equals]
+_FIRST_OP = VAR + 1
+_OPCODES = {cls: _FIRST_OP + i for i, cls in enumerate(OPERATORS)}
+_ARITY = [2 if issubclass(cls, (BinOp, Equals)) else 1
+          for cls in OPERATORS]
+
+_DOUBLE = struct.Struct("<d")
+_COMPLEX = struct.Struct("<dd")
+
+
+class DecodeError(Exception):
+    """Raised when bytes are not a valid encoded expression"""
+    pass
+
+
+def encode(exp: Expr) -> bytes:
+    """The binary encoding of exp."""
+    names = {}
+    body = bytearray()
+    stack = [exp]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Const):
+            _encode_const(body, node.value)
+        elif isinstance(node, Var):
+            index = names.setdefault(node.name, len(names))
+            body.append(VAR)
+            _write_varint(body, index)
+        else:
+            try:
+                body.append(_OPCODES[type(node)])
+            except KeyError:
+                raise TypeError(
+                    f"Can't encode {type(node).__name__}") from None
+            stack.extend(reversed(node.children()))
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    _write_varint(out, len(names))
+    for name in names:
+        data = name.encode("utf-8")
+        _write_varint(out, len(data))
+        out += data
+    out += body
+    return bytes(out)
+
+
+def decode(data: Union[bytes, bytearray, memoryview]) -> Expr:
+    """The expression encoded in data."""
+    data = memoryview(data)
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise DecodeError("Not an encoded expression")
+    if len(data) <= len(MAGIC) or data[len(MAGIC)] != VERSION:
+        raise DecodeError("Unsupported encoding version")
+    pos = len(MAGIC) + 1
+    count, pos = _read_varint(data, pos)
+    names = []
+    for _ in range(count):
+        size, pos = _read_varint(data, pos)
+        if pos + size > len(data):
+            raise DecodeError("Truncated variable name")
+        try:
+            names.append(Var(str(data[pos:pos + size], "utf-8")))
+        except UnicodeDecodeError as e:
+            raise DecodeError(f"Bad variable name: {e}") from None
+        pos += size
+
+    # Read the prefix-order body into a flat list, then build the
+    # tree from the end: every node's children are then already
+    # built and on top of the stack, left child uppermost.
+    items: List[object] = []
+    pending = 1
+    while pending:
+        if pos >= len(data):
+            raise DecodeError("Truncated expression")
+        op = data[pos]
+        pos += 1
+        pending -= 1
+        if op == INT:
+            z, pos = _read_varint(data, pos)
+            items.append(Const(z >> 1 if not z & 1 else -(z >> 1) - 1))
+        elif op == FLOAT:
+            pos = _check(data, pos, _DOUBLE.size)
+            items.append(Const(_DOUBLE.unpack_from(data, pos - 8)[0]))
+        elif op == COMPLEX:
+            pos = _check(data, pos, _COMPLEX.size)
+            real, imag = _COMPLEX.unpack_from(data, pos - 16)
+            items.append(Const(complex(real, imag)))
+        elif op == VAR:
+            index, pos = _read_varint(data, pos)
+            if index >= len(names):
+                raise DecodeError(f"No variable number {index}")
+            items.append(names[index])
+        elif op - _FIRST_OP < len(OPERATORS):
+            items.append(op - _FIRST_OP)
+            pending += _ARITY[op - _FIRST_OP]
+        else:
+            raise DecodeError(f"Unknown opcode {op}")
+    if pos != len(data):
+        raise DecodeError("Trailing bytes after expression")
+
+    built: List[Expr] = []
+    for item in reversed(items):
+        if isinstance(item, Expr):
+            built.append(item)
+        elif _ARITY[item] == 2:
+            left = built.pop()
+            built[-1] = OPERATORS[item](left, built[-1])
+        else:
+            built[-1] = OPERATORS[item](built[-1])
+    return built[0]
+
+
+def _encode_const(out: bytearray, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, complex)):
+        raise TypeError(f"Can't encode constant {value!r}")
+    if isinstance(value, int):
+        out.append(INT)
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += _DOUBLE.pack(value)
+    else:
+        out.append(COMPLEX)
+        out += _COMPLEX.pack(value.real, value.imag)
+
+
+def _write_varint(out: bytearray, n: int):
+    """Append the non-negative n, 7 bits per byte, low bits first"""
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data: memoryview, pos: int):
+    """The varint at pos, and the position after it"""
+    n = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise DecodeError("Truncated number")
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _check(data: memoryview, pos: int, size: int) -> int:
+    if pos + size > len(data):
+        raise DecodeError("Truncated number")
+    return pos + size
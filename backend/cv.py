@@ -6,17 +6,26 @@ for image classification and calculating an output.
 """
 from LANNIN import IMAGE_CLASSIFIER
 """
-from llcalc import calc
+import metrics
+from expr import Budget, Context
+from llcalc import calc_value
 
-def image_compute(f):
+def image_compute(f, budget=None):
     """
     This function will return an output for a given image. 
+    Raises an exception if the expression can't be calculated,
+    or costs more than budget (by default, a Budget()).
     """
     
-    """
-    exp_str = IMAGE_CLASSIFIER(f)
-    """
+    with metrics.stage("classify"):
+        """
+        exp_str = IMAGE_CLASSIFIER(f)
+        """
 
-    exp_str = "2 + 4 = x"
-    output = calc(exp_str)
+        exp_str = "2 + 4 = x"
+    # Each request gets its own variables, and a budget so that
+    # a pathological expression can't tie up the server
+    if budget is None:
+        budget = Budget()
+    output = calc_value(exp_str, Context(budget=budget))
     return output
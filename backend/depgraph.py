@@ -0,0 +1,98 @@
+"""
+Evaluation context that tracks dependencies between variables.
+
+In a plain expr.Context, "y = x + 1" stores the value y has at
+that moment, and changing x later leaves y stale.  A
+DependentContext remembers the formula each variable was defined
+by and which variables that formula reads, like the cells of a
+spreadsheet.  Reassigning a variable marks everything that
+depends on it, directly or indirectly, as stale; a stale variable
+is recomputed from its formula the next time it is read, so only
+dependents that are actually used get recomputed.
+"""
+from typing import Dict, Set
+
+import expr
+
+
+class DependentContext(expr.Context):
+    """A Context whose defined variables follow their inputs"""
+
+    def __init__(self, budget: expr.Budget = None):
+        super().__init__(budget=budget)
+        self.formulas: Dict[str, expr.Expr] = {}
+        self.reads: Dict[str, Set[str]] = {}
+        self.readers: Dict[str, Set[str]] = {}
+        self.stale: Set[str] = set()
+        self.recomputed = 0
+
+    def lookup(self, name: str) -> expr.Const:
+        if name in self.stale:
+            # Stays stale if recomputing fails, so the old value is
+            # never passed off as current
+            self.vars[name] = self.formulas[name].eval_stack(self)
+            self.stale.discard(name)
+            self.recomputed += 1
+        return super().lookup(name)
+
+    def assign(self, name: str, value: expr.Const):
+        """Set name to a value of its own, dropping any formula"""
+        self._forget_formula(name)
+        self.vars[name] = value
+        self._invalidate(name)
+
+    def define(self, name: str, formula: expr.Expr,
+               value: expr.Const = None):
+        """Define name by formula.  A formula that depends on name
+        itself (like x = x + 1) can't be kept up to date, so name
+        just gets its current value, as in a plain Context.
+        """
+        if value is None:
+            value = formula.eval_stack(self)
+        reads = {node.name for node in formula.postorder()
+                 if isinstance(node, expr.Var)}
+        if self._depends_on(reads, name):
+            self.assign(name, value)
+            return
+        self._forget_formula(name)
+        self.formulas[name] = formula
+        self.reads[name] = reads
+        for read in reads:
+            self.readers.setdefault(read, set()).add(name)
+        self.vars[name] = value
+        self._invalidate(name)
+
+    def clear(self):
+        super().clear()
+        self.formulas.clear()
+        self.reads.clear()
+        self.readers.clear()
+        self.stale.clear()
+
+    def _depends_on(self, reads: Set[str], name: str) -> bool:
+        """True if any of reads is name or is computed from it"""
+        seen = set()
+        todo = list(reads)
+        while todo:
+            read = todo.pop()
+            if read == name:
+                return True
+            if read not in seen:
+                seen.add(read)
+                todo.extend(self.reads.get(read, ()))
+        return False
+
+    def _forget_formula(self, name: str):
+        self.formulas.pop(name, None)
+        self.stale.discard(name)
+        for read in self.reads.pop(name, ()):
+            self.readers[read].discard(name)
+
+    def _invalidate(self, name: str):
+        """Mark every variable computed from name as stale"""
+        todo = list(self.readers.get(name, ()))
+        while todo:
+            reader = todo.pop()
+            if reader not in self.stale:
+                self.stale.add(reader)
+                todo.extend(self.readers.get(reader, ()))
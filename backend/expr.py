@@ -2,16 +2,26 @@
 
 Author: Justin Spidell
 """
-import logging
+import os
+import time
+import weakref
+from fractions import Fraction
+from typing import Callable, Dict, List, Optional, Tuple
 
-logging.basicConfig()
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
+import metrics
+import tracing
+from lru import LRUCache
 
 # One global environment (scope) for
 # the calculator
 ENV = dict()
 
+# Solved forms of equations, keyed by the equation's structure.
+# Solving doesn't depend on variable values, so entries stay
+# valid however ENV changes.
+SOLUTION_CACHE = LRUCache(
+    capacity=int(os.environ.get("EXPR_SOLUTION_CACHE_SIZE", 256)))
+
 
 def env_clear():
     """Clear all variables in calculator memory."""
@@ -19,13 +29,205 @@ def env_clear():
     ENV = dict()
 
 
+# CPU time of the current thread, where Python can measure it
+_cpu_time = getattr(time, "thread_time", time.process_time)
+
+
+class BudgetExceeded(Exception):
+    """Raised when evaluating an expression would go over the
+    limits of its Budget
+    """
+    pass
+
+
+class Budget(object):
+    """Limits on the cost of evaluating one expression.  Any limit
+    may be None for no limit.
+        max_nodes:   nodes in the tree
+        max_depth:   nesting depth of the tree
+        max_bits:    estimated size of a product or power of
+                     integers, checked before computing it
+        max_steps:   operations evaluated
+        max_seconds: CPU time used by the evaluating thread, so
+                     that a busy server doesn't fail good input
+    The tree limits are checked before evaluation starts, the
+    others as it goes.  There is no depth limit by default:
+    eval_stack doesn't recurse, so a deep tree costs no more
+    than max_nodes allows.
+    """
+
+    def __init__(self, max_nodes: int = 10000, max_depth: int = None,
+                 max_bits: int = 8192, max_steps: int = 100000,
+                 max_seconds: float = 1.0):
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.max_bits = max_bits
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+
+    def check_tree(self, exp: "Expr"):
+        """Raise BudgetExceeded if exp is too big or too deep"""
+        nodes = 0
+        stack = [(exp, 1)]
+        while stack:
+            node, depth = stack.pop()
+            nodes += 1
+            if self.max_nodes is not None and nodes > self.max_nodes:
+                raise BudgetExceeded(
+                    f"Expression has more than {self.max_nodes} nodes")
+            if self.max_depth is not None and depth > self.max_depth:
+                raise BudgetExceeded(
+                    f"Expression is nested more than {self.max_depth} deep")
+            stack.extend((child, depth + 1) for child in node.children())
+
+    def start(self, exp: "Expr") -> "_Meter":
+        """Check exp, and begin measuring its evaluation"""
+        self.check_tree(exp)
+        return _Meter(self)
+
+
+class _Meter(object):
+    """What one evaluation has used of its Budget so far"""
+    __slots__ = ('budget', 'steps', 'deadline')
+
+    # Check the clock only every so many steps
+    CLOCK_INTERVAL = 64
+
+    def __init__(self, budget: Budget):
+        self.budget = budget
+        self.steps = 0
+        self.deadline = None
+        if budget.max_seconds is not None:
+            self.deadline = _cpu_time() + budget.max_seconds
+
+    def charge(self, node: "Expr", left, right=None):
+        """Account for applying node to operands left and right"""
+        budget = self.budget
+        self.steps += 1
+        if budget.max_steps is not None and self.steps > budget.max_steps:
+            raise BudgetExceeded(
+                f"Evaluation took more than {budget.max_steps} steps")
+        if self.deadline is not None \
+                and self.steps % self.CLOCK_INTERVAL == 0 \
+                and _cpu_time() > self.deadline:
+            raise BudgetExceeded(
+                f"Evaluation took more than {budget.max_seconds} CPU seconds")
+        if budget.max_bits is not None:
+            bits = node._result_bits(left, right)
+            if bits > budget.max_bits:
+                raise BudgetExceeded(
+                    f"{node.op_name} result would have about {bits} bits, "
+                    f"more than {budget.max_bits}")
+
+
+class Context(object):
+    """The variables of one evaluation.  Passing a separate
+    Context to eval (or llcalc.calc) for each request lets
+    requests run in parallel threads without seeing each other's
+    variables.  Evaluations given no Context use DEFAULT_CONTEXT,
+    whose variables are the global ENV.
+
+    A Context may also carry a Budget limiting the cost of each
+    evaluation in it.
+    """
+
+    def __init__(self, variables: Dict[str, "Const"] = None,
+                 budget: Budget = None):
+        self.vars = {} if variables is None else variables
+        self.budget = budget
+        self.meter = None
+
+    def measure(self, exp: "Expr", compute: Callable):
+        """Run compute(), which evaluates exp, within the budget.
+        Evaluations nested inside it share its meter.
+        """
+        if self.budget is None or self.meter is not None:
+            return compute()
+        self.meter = self.budget.start(exp)
+        try:
+            return compute()
+        finally:
+            self.meter = None
+
+    def lookup(self, name: str) -> "Const":
+        """The value of variable name"""
+        try:
+            return self.vars[name]
+        except KeyError:
+            raise UndefinedVariable(
+                f'{name} has not been assigned a value') from None
+
+    def assign(self, name: str, value: "Const"):
+        """Set the value of variable name"""
+        self.vars[name] = value
+
+    def define(self, name: str, formula: "Expr", value: "Const" = None):
+        """Set variable name to the value of formula, which is
+        evaluated here unless its value is given.  A plain
+        Context keeps only the value.
+        """
+        if value is None:
+            value = formula.eval_stack(self)
+        self.assign(name, value)
+
+    def clear(self):
+        """Forget all variables"""
+        self.vars.clear()
+
+
+class _GlobalContext(Context):
+    """The default context, which always uses the current ENV
+    (env_clear replaces it).
+    """
+
+    budget = None
+    meter = None
+
+    def __init__(self):
+        pass
+
+    @property
+    def vars(self) -> Dict[str, "Const"]:
+        return ENV
+
+
+DEFAULT_CONTEXT = _GlobalContext()
+
+
+def configure_solution_cache(capacity: int = 256, policy: str = "lru"):
+    """Replace the solution cache with an empty one of the given
+    capacity and eviction policy.  Capacity 0 disables caching.
+    """
+    global SOLUTION_CACHE
+    SOLUTION_CACHE = LRUCache(capacity=capacity, policy=policy)
+
+
+metrics.register_cache("solution", lambda: SOLUTION_CACHE.stats())
+
+
 class Expr(object):
-    """Abstract base class of all expressions."""
+    """Abstract base class of all expressions.
+
+    Nodes use __slots__ and are immutable once built, so they
+    can be shared: equal Const and Var leaves are interned, and
+    whole trees hash and compare by structure.
+
+    Evaluation reads and assigns variables in a Context, by
+    default DEFAULT_CONTEXT.
+    """
+    __slots__ = ()
+
+    def eval(self, ctx: Context = None) -> "Const":
+        """Evaluate to an integer constant."""
+        ctx = ctx or DEFAULT_CONTEXT
+        return Const(ctx.measure(self, lambda: self._value(ctx)))
 
-    def eval(self) -> "Const":
-        """Implementations of eval should return an integer constant."""
+    def _value(self, ctx: Context):
+        """Implementations of _value should return the plain value
+        of the expression, without wrapping it in a Const.
+        """
         raise NotImplementedError(
-            'Each concrete Expr class must define "eval"')
+            'Each concrete Expr class must define "_value"')
 
     def __str__(self) -> str:
         """Implementations of __str__ should return the expression in
@@ -41,53 +243,210 @@ class Expr(object):
         raise NotImplementedError(
             'Each concrete Expr class must define __repr__')
 
+    def compile(self, constant: Optional[Callable] = None) -> Callable:
+        """Compile the expression into a Python function of its
+        variables, for evaluating it many times.  The function
+        takes the variable values as keyword arguments or as one
+        dict, and returns a plain number, e.g.
+            f = Plus(Var("x"), Const(1)).compile()
+            f(x=2) == f({"x": 2}) == 3
+        It computes exactly what eval() would, without walking
+        the tree or creating Const nodes.  If constant is given,
+        every constant is passed through it first, e.g. to make
+        it a NumPy scalar.
+        """
+        compiler = _Compiler(constant)
+        operands = []
+        for node in self.postorder():
+            arity = len(node.children())
+            args = operands[len(operands) - arity:]
+            del operands[len(operands) - arity:]
+            operands.append(node._emit(compiler, *args))
+        return compiler.function(operands[0])
+
+    def _emit(self, compiler: "_Compiler", *operands: str) -> str:
+        """Implementations of _emit add the code computing the
+        expression, given the code for its children's values,
+        to compiler and return a Python expression (a name or
+        literal) for its value.
+        """
+        raise NotImplementedError(
+            'Each concrete Expr class must define "_emit"')
+
+    def children(self) -> Tuple["Expr", ...]:
+        """The direct subexpressions, left to right."""
+        return ()
+
+    def _simplify(self, *children: "Expr") -> "Expr":
+        """Implementations of _simplify return the simplest form of
+        this node, given its children already simplified.  Leaves
+        are already as simple as they get.
+        """
+        return self
+
+    def postorder(self) -> List["Expr"]:
+        """All the nodes of the tree, each after its children.
+        Built with an explicit stack, so it works on trees of
+        any depth.
+        """
+        stack = [self]
+        nodes = []
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children())
+        nodes.reverse()
+        return nodes
+
+    def eval_stack(self, ctx: Context = None) -> "Const":
+        """Same result as eval(), but computed over the postorder
+        sequence of nodes with an explicit stack of values instead
+        of recursion, so deep trees can't exhaust Python's
+        recursion limit.
+        """
+        ctx = ctx or DEFAULT_CONTEXT
+        return Const(ctx.measure(self, lambda: self._value_stack(ctx)))
+
+    def _value_stack(self, ctx: Context):
+        values = []
+        for node in self.postorder():
+            if isinstance(node, Const):
+                values.append(node.value)
+            elif isinstance(node, Var):
+                values.append(node.eval(ctx).value)
+            elif isinstance(node, BinOp):
+                right = values.pop()
+                left = values[-1]
+                if ctx.meter is not None:
+                    ctx.meter.charge(node, left, right)
+                values[-1] = node._apply(left, right)
+                if tracing.ENABLED:
+                    tracing.event("eval", node.op_name, left=left,
+                                  right=right, result=values[-1])
+            elif isinstance(node, Unop):
+                left = values[-1]
+                if ctx.meter is not None:
+                    ctx.meter.charge(node, left)
+                values[-1] = node._apply(left)
+                if tracing.ENABLED:
+                    tracing.event("eval", node.op_name, left=left,
+                                  result=values[-1])
+            else:
+                raise NotImplementedError(
+                    f"eval_stack can't evaluate {type(node).__name__}")
+        return values[0]
+
+    def __hash__(self) -> int:
+        return hash((type(self),) + tuple(map(hash, self.children())))
+
+    def __eq__(self, other: object) -> bool:
+        """Structural equality, compared with an explicit stack"""
+        pairs = [(self, other)]
+        while pairs:
+            a, b = pairs.pop()
+            if a is b:
+                continue
+            if type(a) is not type(b):
+                return False
+            if not a.children():
+                if not a._same_leaf(b):
+                    return False
+                continue
+            if hash(a) != hash(b):
+                return False
+            pairs.extend(zip(a.children(), b.children()))
+        return True
+
     def _find_var(self, curr):
-        log.debug(f"_find_var:{curr.__repr__()}")
-        if isinstance(curr, Var):
-            return True
-        if isinstance(curr, Const):
-            return False
-        if not isinstance(curr.left, Const):
-            if self._find_var(curr.left):
-                return True
-        if not isinstance(curr.right, Const):
-            if self._find_var(curr.right):
+        stack = [curr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Var):
                 return True
+            stack.extend(node.children())
         return False
 
 
 class Const(Expr):
-    """Class for integers, used for all Expr functions."""
+    """Class for integers, used for all Expr functions.
+    Integer constants are interned: Const(5) is Const(5).
+    """
+    __slots__ = ('value', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, value: int):
+        if type(value) is not int:
+            return super().__new__(cls)
+        const = cls._interned.get(value)
+        if const is None:
+            const = super().__new__(cls)
+            cls._interned[value] = const
+        return const
 
     def __init__(self, value: int):
         self.value = value
 
+    def __reduce__(self):
+        return Const, (self.value,)
+
     def __str__(self) -> str:
         return str(self.value)
 
     def __repr__(self) -> str:
         return f'Const({self.value})'
 
-    def eval(self) -> 'Const':
+    def eval(self, ctx: Context = None) -> 'Const':
         """Eval of a constant integer is a constant integer."""
-        log.debug(self.__repr__())
         return self
 
+    def _value(self, ctx: Context):
+        return self.value
+
     def __eq__(self, other: Expr) -> bool:
         return isinstance(other, Const) and self.value == other.value
 
+    def __hash__(self) -> int:
+        return hash((Const, self.value))
+
+    def _same_leaf(self, other: 'Const') -> bool:
+        # Trees are the same only if their constants have the same
+        # type too: solving x / 2 = 2 gives an int, x / 2 = 2.0 a
+        # float, so they mustn't share a SOLUTION_CACHE entry
+        return type(self.value) is type(other.value) and \
+            self.value == other.value
+
+    def _emit(self, compiler: "_Compiler") -> str:
+        if compiler.convert is not None:
+            return compiler.constant(compiler.convert(self.value))
+        if type(self.value) is int:
+            return f"({self.value})"
+        return compiler.constant(self.value)
+
 
 class BinOp(Expr):
-    """Abstract base class of all binary operation classes."""
+    """Abstract base class of all binary operation classes.
+    Each concrete subclass sets op_sym and op_name.
+    """
+    __slots__ = ('left', 'right', '_hash')
 
-    def __init__(self):
-        raise NotImplementedError('Do not instantiate BinOp')
+    op_sym: str
+    op_name: str
 
-    def _binop_init(self, left: Expr, right: Expr, op_sym: str, op_name: str):
+    def __init__(self, left: Expr, right: Expr):
+        if type(self) is BinOp:
+            raise NotImplementedError('Do not instantiate BinOp')
         self.left = left
         self.right = right
-        self.op_sym = op_sym
-        self.op_name = op_name
+        self._hash = None
+
+    def __reduce__(self):
+        return type(self), (self.left, self.right)
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            _cache_hashes(self)
+        return self._hash
 
     def __str__(self) -> str:
         return f'({self.left} {self.op_sym} {self.right})'
@@ -95,43 +454,90 @@ class BinOp(Expr):
     def __repr__(self) -> str:
         return f'{self.op_name}({repr(self.left)}, {repr(self.right)})'
 
-    def eval(self) -> 'Const':
-        """Each concrete subclass must define _apply(int, int) -> int"""
-        log.debug(self.__repr__())
-        left_val = self.left.eval()
-        right_val = self.right.eval()
-        return Const(self._apply(left_val.value, right_val.value))
+    def children(self) -> Tuple[Expr, Expr]:
+        return self.left, self.right
+
+    def _emit(self, compiler: "_Compiler", left: str, right: str) -> str:
+        return compiler.assign(self._py_op.format(left, right))
+
+    def _simplify(self, left: Expr, right: Expr) -> Expr:
+        if isinstance(left, Const) and isinstance(right, Const):
+            if self._can_fold(left.value, right.value):
+                try:
+                    return Const(self._apply(left.value, right.value))
+                except (ArithmeticError, ValueError):
+                    # Leave it for eval to report
+                    pass
+        identity = self._identity(left, right)
+        if identity is not None:
+            return identity
+        if left is self.left and right is self.right:
+            return self
+        return type(self)(left, right)
+
+    def _can_fold(self, left, right) -> bool:
+        # Folding happens before any Budget applies, so don't
+        # compute anything that could be huge
+        return self._result_bits(left, right) <= FOLD_MAX_BITS
+
+    def _identity(self, left: Expr, right: Expr):
+        """The operand this node reduces to by an algebraic
+        identity like x + 0 = x, or None if there is none.
+        """
+        return None
 
-    def _reverse(self, other):
-        log.debug(f"_reverse:{self.__repr__()}")
+    def _result_bits(self, left, right) -> float:
+        """Estimated bit length of _apply(left, right), for
+        budgeting operations whose results can grow large.
+        """
+        return 0
 
-        if isinstance(self, Const):
-            raise SyntaxError(
-                "_reverse should never be called on an Const")
+    def _value(self, ctx: Context):
+        """Each concrete subclass must define _apply(int, int) -> int"""
+        left_val = self.left._value(ctx)
+        right_val = self.right._value(ctx)
+        if ctx.meter is not None:
+            ctx.meter.charge(self, left_val, right_val)
+        result = self._apply(left_val, right_val)
+        if tracing.ENABLED:
+            tracing.event("eval", self.op_name, left=left_val,
+                          right=right_val, result=result)
+        return result
 
-        if isinstance(self.left, Var) or self._find_var(self.left):
-            new_other = self._opp(other, self.right)
-            new_self = self.left
+    def _reverse(self, other):
+        if self._find_var(self.left):
+            return self._peel(other, True)
+        elif self._find_var(self.right):
+            return self._peel(other, False)
+        raise NotImplementedError(
+            "Tried to solve but couldn't find the variable")
 
-        elif isinstance(self.right, Var) or self._find_var(self.right):
-            if (not isinstance(self, Minus)) and (not isinstance(self, Div)):
-                new_other = self._opp(other, self.left)
-                new_self = self.right
-            else:
-                if isinstance(self, Minus):
-                    new_other = Neg(Minus(other, self.left))
-                    new_self = self.right
-                elif isinstance(self, Div):
-                    new_other = Times(self.left, Div(Const(1), other))
-                    new_self = self.right
-        return new_self, new_other
+    def _peel(self, other: Expr, var_on_left: bool):
+        """Undo this operation on other, for self = other.
+        Returns the child holding the variable and the new other
+        side; the caller says which child holds the variable.
+        """
+        if tracing.ENABLED:
+            tracing.event("solve", "reverse", op=self.op_name)
+
+        if var_on_left:
+            return self.left, self._opp(other, self.right)
+        elif isinstance(self, Minus):
+            return self.right, Neg(Minus(other, self.left))
+        elif isinstance(self, Div):
+            return self.right, Times(self.left, Div(Const(1), other))
+        else:
+            return self.right, self._opp(other, self.left)
 
 
 class Plus(BinOp):
     """Expr + Expr"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '+', 'Plus')
+    _py_op = "{} + {}"
+
+    __slots__ = ()
+    op_sym = '+'
+    op_name = 'Plus'
 
     def _apply(self, left: int, right: int) -> int:
         return left + right
@@ -139,12 +545,22 @@ class Plus(BinOp):
     def _opp(self, left, right):
         return Minus(left, right)
 
+    def _identity(self, left: Expr, right: Expr):
+        if _is_int(right, 0):
+            return left
+        if _is_int(left, 0):
+            return right
+        return None
+
 
 class Minus(BinOp):
     """Expr - Expr"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '-', 'Minus')
+    _py_op = "{} - {}"
+
+    __slots__ = ()
+    op_sym = '-'
+    op_name = 'Minus'
 
     def _apply(self, left: int, right: int) -> int:
         return left - right
@@ -152,12 +568,18 @@ class Minus(BinOp):
     def _opp(self, left, right):
         return Plus(left, right)
 
+    def _identity(self, left: Expr, right: Expr):
+        return left if _is_int(right, 0) else None
+
 
 class Times(BinOp):
     """Expr * Expr"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '*', 'Times')
+    _py_op = "{} * {}"
+
+    __slots__ = ()
+    op_sym = '*'
+    op_name = 'Times'
 
     def _apply(self, left: int, right: int) -> int:
         return left * right
@@ -165,12 +587,27 @@ class Times(BinOp):
     def _opp(self, left, right):
         return Div(left, right)
 
+    def _identity(self, left: Expr, right: Expr):
+        if _is_int(right, 1):
+            return left
+        if _is_int(left, 1):
+            return right
+        return None
+
+    def _result_bits(self, left, right) -> float:
+        if type(left) is int and type(right) is int:
+            return left.bit_length() + right.bit_length()
+        return 0
+
 
 class Div(BinOp):
     """Expr // Expr"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '/', 'Div')
+    _py_op = "{} / {}"
+
+    __slots__ = ()
+    op_sym = '/'
+    op_name = 'Div'
 
     def _apply(self, left: int, right: int) -> int:
         return left / right
@@ -182,8 +619,11 @@ class Div(BinOp):
 class Raise(BinOp):
     """(Expr)^(Expr)"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '^', 'Raise')
+    _py_op = "{} ** {}"
+
+    __slots__ = ()
+    op_sym = '^'
+    op_name = 'Raise'
 
     def _apply(self, left: int, right: int) -> int:
         return left ** right
@@ -191,12 +631,21 @@ class Raise(BinOp):
     def _opp(self, left, right):
         return Root(left, right)
 
+    def _result_bits(self, left, right) -> float:
+        return _pow_bits(left, right)
+
+    def _identity(self, left: Expr, right: Expr):
+        return left if _is_int(right, 1) else None
+
 
 class Root(BinOp):
     """Sqrt(Expr)"""
 
-    def __init__(self, left: Expr, right: Expr):
-        self._binop_init(left, right, '|', 'Root')
+    _py_op = "{} ** (1 / {})"
+
+    __slots__ = ()
+    op_sym = '|'
+    op_name = 'Root'
 
     def _apply(self, left: int, right: int) -> int:
         return left ** (1 / right)
@@ -206,15 +655,27 @@ class Root(BinOp):
 
 
 class Unop(Expr):
-    """Abstract base class of all Unary operations."""
+    """Abstract base class of all Unary operations.
+    Each concrete subclass sets op_sym and op_name.
+    """
+    __slots__ = ('left', '_hash')
 
-    def __init__(self):
-        raise NotImplementedError('Do not instantiate UnOp')
+    op_sym: str
+    op_name: str
 
-    def _Unop_init(self, left: Expr, op_sym: str, op_name: str):
+    def __init__(self, left: Expr):
+        if type(self) is Unop:
+            raise NotImplementedError('Do not instantiate UnOp')
         self.left = left
-        self.op_sym = op_sym
-        self.op_name = op_name
+        self._hash = None
+
+    def __reduce__(self):
+        return type(self), (self.left,)
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            _cache_hashes(self)
+        return self._hash
 
     def __str__(self) -> str:
         return f'{self.op_sym} {self.left}'
@@ -222,120 +683,457 @@ class Unop(Expr):
     def __repr__(self) -> str:
         return f'{self.op_name}({repr(self.left)})'
 
-    def eval(self) -> 'Const':
-        log.debug(self.__repr__())
-        left_val = self.left.eval()
-        return Const(self._apply(left_val.value))
+    def children(self) -> Tuple[Expr]:
+        return self.left,
+
+    def _emit(self, compiler: "_Compiler", left: str) -> str:
+        return compiler.assign(self._py_op.format(left))
+
+    def _simplify(self, left: Expr) -> Expr:
+        if isinstance(left, Const):
+            return Const(self._apply(left.value))
+        if left is self.left:
+            return self
+        return type(self)(left)
+
+    def _result_bits(self, left, right) -> float:
+        return 0
+
+    def _value(self, ctx: Context):
+        left_val = self.left._value(ctx)
+        if ctx.meter is not None:
+            ctx.meter.charge(self, left_val)
+        result = self._apply(left_val)
+        if tracing.ENABLED:
+            tracing.event("eval", self.op_name, left=left_val,
+                          result=result)
+        return result
 
 
 class Abs(Unop):
     """Abs(Expr)"""
 
-    def __init__(self, left: Expr):
-        self._Unop_init(left, '@', 'Abs')
+    _py_op = "abs({})"
+
+    __slots__ = ()
+    op_sym = '@'
+    op_name = 'Abs'
 
     def _apply(self, left: int) -> int:
         return abs(left)
 
+    def _peel(self, other: Expr, var_on_left: bool):
+        raise NotImplementedError(
+            "Can't solve for a variable inside an absolute value")
+
 
 class Neg(Unop):
     """-(Expr)"""
 
-    def __init__(self, left: Expr):
-        self._Unop_init(left, '~', 'Neg')
+    _py_op = "-{}"
+
+    __slots__ = ()
+    op_sym = '~'
+    op_name = 'Neg'
 
     def _apply(self, left: int) -> int:
         return -left
 
+    def _simplify(self, left: Expr) -> Expr:
+        if isinstance(left, Neg):
+            return left.left
+        return super()._simplify(left)
+
+    def _peel(self, other: Expr, var_on_left: bool):
+        if tracing.ENABLED:
+            tracing.event("solve", "reverse", op=self.op_name)
+        return self.left, Neg(other)
+
 
 class UndefinedVariable(Exception):
     """Raised when expression tries to use a variable that
-    is not in ENV
+    is not in its Context
     """
     pass
 
 
+class NoSolution(Exception):
+    """Raised when an equation has no solution, or infinitely many"""
+    pass
+
+
 class Var(Expr):
     """Variable class, for any token that isn't an integer,
-    x = repersented as Var(x).
+    x = repersented as Var(x).  Variables are interned by name.
     """
+    __slots__ = ('name', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, name: str):
+        var = cls._interned.get(name)
+        if var is None:
+            var = super().__new__(cls)
+            cls._interned[name] = var
+        return var
 
     def __init__(self, name: str):
         self.name = name
 
+    def __reduce__(self):
+        return Var, (self.name,)
+
+    def __eq__(self, other: Expr) -> bool:
+        return isinstance(other, Var) and self.name == other.name
+
+    def __hash__(self) -> int:
+        return hash((Var, self.name))
+
+    def _same_leaf(self, other: 'Var') -> bool:
+        return self.name == other.name
+
     def __str__(self) -> str:
         return self.name
 
     def __repr__(self) -> str:
         return f'Var({self.name})'
 
-    def eval(self) -> str:
-        global ENV
-        if self.name in ENV:
-            return ENV[self.name]
-        else:
-            raise UndefinedVariable(
-                f'{self.name} has not been assigned a value')
-        log.debug(self.__repr__())
-        pass
+    def eval(self, ctx: Context = None) -> Const:
+        value = (ctx or DEFAULT_CONTEXT).lookup(self.name)
+        if tracing.ENABLED:
+            tracing.event("eval", "Var", var=self.name, result=value)
+        return value
+
+    def _value(self, ctx: Context):
+        return self.eval(ctx).value
 
-    def assign(self, value: Const):
-        global ENV
-        ENV[self.name] = value
+    def assign(self, value: Const, ctx: Context = None):
+        (ctx or DEFAULT_CONTEXT).assign(self.name, value)
+
+    def _emit(self, compiler: "_Compiler") -> str:
+        return compiler.variable(self.name)
 
 
 class Equals(Expr):
     """Equals: x = y represented as Equals(x, y)."""
 
+    __slots__ = ('left', 'right')
+
     def __init__(self, left: Expr, right: Expr):
         self.left = left
         self.right = right
 
-    def eval(self) -> Const:
-        log.debug(self.__repr__())
+    def __reduce__(self):
+        return Equals, (self.left, self.right)
 
-        if isinstance(self.left, Var):
-            log.debug("Var on left")
-            r_val = self.right.eval()
-            self.left.assign(r_val)
-            return r_val
+    def children(self) -> Tuple[Expr, Expr]:
+        return self.left, self.right
 
+    def eval(self, ctx: Context = None) -> Const:
+        # The other side may be a generated expression of any
+        # depth, so evaluate it without recursion
+        return self._solve(lambda side: side.eval_stack(ctx), ctx)
+
+    def eval_stack(self, ctx: Context = None) -> Const:
+        return self._solve(lambda side: side.eval_stack(ctx), ctx)
+
+    def _value(self, ctx: Context):
+        return self.eval(ctx).value
+
+    def _solve(self, evaluate: Callable[[Expr], Const],
+               ctx: Context) -> Const:
+        """Isolate the variable, then assign it the value of the
+        other side, computed with evaluate.
+        """
+        var, other = self.solved()
+        if tracing.ENABLED:
+            tracing.event("solve", "assign", var=var)
+        value = evaluate(other)
+        (ctx or DEFAULT_CONTEXT).define(var.name, other, value)
+        return value
+
+    def solved(self) -> Tuple[Var, Expr]:
+        """The variable this equation assigns, and the expression
+        for its value.  The equation itself is left unchanged, and
+        solutions are remembered in SOLUTION_CACHE.
+        """
+        assignment = None
+        if isinstance(self.left, Var):
+            assignment = self.left, self.right
         elif isinstance(self.right, Var):
-            log.debug("Var on right")
-            l_val = self.left.eval()
-            self.right.assign(l_val)
-            return l_val
+            assignment = self.right, self.left
+        # A plain assignment, unless the variable is on both sides
+        # (like x = 3 * x - 4), which makes it an equation to solve
+        if assignment and not _mentions(assignment[1], assignment[0].name):
+            return assignment
+        solution = SOLUTION_CACHE.get(self, None)
+        if tracing.ENABLED:
+            tracing.event("solve", "solution_cache", hit=solution is not None)
+        if solution is None:
+            try:
+                solution = self._solve_linear()
+            except NoSolution:
+                # x = x + 1 has no solution, but reads as an update
+                if assignment is None:
+                    raise
+            solution = solution or assignment or self._isolate()
+            SOLUTION_CACHE.put(self, solution)
+        return solution
+
+    def _solve_linear(self):
+        """Solve an equation whose only variable appears more than
+        once, like x + 2 = x * 3, by reducing each side to
+        a * x + c.  Returns None if the equation isn't of that
+        kind or isn't linear, to be solved by isolation instead.
+        """
+        names = [node.name for node in self.postorder()
+                 if isinstance(node, Var)]
+        if len(names) < 2 or len(set(names)) > 1:
+            return None
+        left = linear_form(self.left, names[0])
+        right = linear_form(self.right, names[0])
+        if left is None or right is None:
+            return None
+        if tracing.ENABLED:
+            tracing.event("solve", "linear", left=left, right=right)
+        (left_coef, left_const), (right_coef, right_const) = left, right
+        if left_coef == right_coef:
+            raise NoSolution(f"{self} has no unique solution")
+        value = _exact_div(right_const - left_const, left_coef - right_coef)
+        return Var(names[0]), Const(_plain(value))
+
+    def _emit(self, compiler: "_Compiler", left: str, right: str) -> str:
+        raise NotImplementedError(
+            "An equation can't be compiled, only expressions can")
 
-        else:
-            if isinstance(self.left, Const):
-                left = False
-            else:
-                left = self._find_var(self.left)
-            if isinstance(self.right, Const):
-                right = False
-            else:
-                right = self._find_var(self.right)
-
-            if left:
-                log.debug("solving left side")
-                self._isolate("left")
-                return self.eval()
-            elif right:
-                log.debug("solving right side")
-                self._isolate("right")
-                return self.eval()
-            else:
-                raise NotImplementedError(
-                    "Tried to solve but couldn't find the variable")
+    def _simplify(self, left: Expr, right: Expr) -> Expr:
+        if left is self.left and right is self.right:
+            return self
+        return Equals(left, right)
 
-    def _isolate(self, left_right):
-        if left_right == "left":
-            self.left, self.right = self.left._reverse(self.right)
-        if left_right == "right":
-            self.right, self.left = self.right._reverse(self.left)
+    def _isolate(self) -> Tuple[Var, Expr]:
+        """Solve the equation for its variable, moving every
+        operation around the variable to the other side, which is
+        then simplified.
+
+        Which subtrees hold a variable is worked out in one pass
+        over the tree, so each step down to the variable takes
+        constant time instead of searching the subtree again.
+        """
+        with_var = _nodes_with_var(self)
+        if id(self.left) in with_var:
+            left_right = "left"
+            side, other = self.left, self.right
+        elif id(self.right) in with_var:
+            left_right = "right"
+            side, other = self.right, self.left
+        else:
+            raise NotImplementedError(
+                "Tried to solve but couldn't find the variable")
+        if tracing.ENABLED:
+            tracing.event("solve", "isolate", side=left_right)
+        while not isinstance(side, Var):
+            side, other = side._peel(other, id(side.left) in with_var)
+        # Peeling x * x = 4 gives x = 4 / x, which isn't a solution
+        if _mentions(other, side.name):
+            raise NotImplementedError(
+                f"Can't solve for {side.name}: it appears non-linearly")
+        return side, simplify(other)
 
     def __str__(self) -> str:
         return f'{self.left} = {self.right}'
 
     def __repr__(self) -> str:
         return f'Equals({self.left.__repr__()}, {self.right.__repr__()})'
+
+
+# Constant products and powers are folded only if their result
+# is expected to fit in this many bits.
+FOLD_MAX_BITS = 4096
+
+
+def simplify(exp: Expr) -> Expr:
+    """A tree equivalent to exp, with constant subtrees folded
+    and identities x + 0, 0 + x, x - 0, x * 1, 1 * x, x ^ 1 and
+    ~ ~ x applied.  Subtrees that don't change are shared with
+    exp, which is not modified.  Folding that fails, such as
+    division by zero, is left for eval to report.
+    """
+    results = []
+    for node in exp.postorder():
+        arity = len(node.children())
+        args = results[len(results) - arity:]
+        del results[len(results) - arity:]
+        results.append(node._simplify(*args))
+    return results[0]
+
+
+def linear_form(exp: Expr, name: str):
+    """(a, c) such that exp is a * name + c, or None if exp is not
+    linear in name or uses any other variable.  Works in one pass
+    over the tree; integer arithmetic is kept exact with Fractions.
+    """
+    forms = []
+    for node in exp.postorder():
+        arity = len(node.children())
+        args = forms[len(forms) - arity:]
+        del forms[len(forms) - arity:]
+        if None in args:
+            forms.append(None)
+        elif isinstance(node, Const):
+            forms.append((0, node.value))
+        elif isinstance(node, Var):
+            forms.append((1, 0) if node.name == name else None)
+        else:
+            forms.append(_linear_op(node, *args))
+    return forms[0]
+
+
+def _linear_op(node: Expr, *args):
+    """Linear form of an operator node from those of its operands"""
+    if all(coef == 0 for coef, _ in args):
+        consts = [const for _, const in args]
+        if isinstance(node, BinOp) and not node._can_fold(*consts):
+            return None
+        if isinstance(node, Div):
+            return 0, _exact_div(*consts)
+        return 0, node._apply(*consts)
+    if isinstance(node, Neg):
+        (coef, const), = args
+        return -coef, -const
+    if len(args) != 2:
+        return None
+    (a1, c1), (a2, c2) = args
+    if isinstance(node, Plus):
+        return a1 + a2, c1 + c2
+    if isinstance(node, Minus):
+        return a1 - a2, c1 - c2
+    if isinstance(node, Times):
+        if a1 == 0:
+            return c1 * a2, c1 * c2
+        if a2 == 0:
+            return a1 * c2, c1 * c2
+    if isinstance(node, Div) and a2 == 0 and c2 != 0:
+        return _exact_div(a1, c2), _exact_div(c1, c2)
+    return None
+
+
+def _exact_div(a, b):
+    """a / b, as a Fraction if both are integers or Fractions"""
+    if isinstance(a, (int, Fraction)) and isinstance(b, (int, Fraction)):
+        return Fraction(a) / b
+    return a / b
+
+
+def _plain(value):
+    """A Fraction as an int if it is whole, else a float"""
+    if isinstance(value, Fraction):
+        return int(value) if value.denominator == 1 else float(value)
+    return value
+
+
+def _nodes_with_var(exp: Expr) -> set:
+    """The ids of the nodes in exp that have a variable in them"""
+    with_var = set()
+    for node in exp.postorder():
+        if isinstance(node, Var) or any(
+                id(child) in with_var for child in node.children()):
+            with_var.add(id(node))
+    return with_var
+
+
+def _mentions(exp: Expr, name: str) -> bool:
+    """Whether variable name appears anywhere in exp"""
+    stack = [exp]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Var) and node.name == name:
+            return True
+        stack.extend(node.children())
+    return False
+
+
+def _is_int(exp: Expr, value: int) -> bool:
+    """True if exp is the integer constant value.  Floats don't
+    count: x * 1.0 changes the type of an integer x.
+    """
+    return isinstance(exp, Const) and type(exp.value) is int \
+        and exp.value == value
+
+
+def _pow_bits(base, exponent) -> float:
+    """Rough upper bound on the bit length of base ** exponent"""
+    if type(base) is not int or type(exponent) is not int \
+            or exponent <= 0 or abs(base) <= 1:
+        return 0
+    return abs(base).bit_length() * exponent
+
+
+def _cache_hashes(exp: Expr):
+    """Fill in the cached hashes of all operator nodes in exp,
+    children first, so no hash needs recursion to compute.
+    """
+    missing = []
+    stack = [exp]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (BinOp, Unop)) and node._hash is None:
+            missing.append(node)
+            stack.extend(node.children())
+    for node in reversed(missing):
+        node._hash = hash((type(node),) + tuple(map(hash, node.children())))
+
+
+class _Compiler(object):
+    """Collects the straight-line Python code for Expr.compile.
+    Every operator node becomes one assignment to a temporary,
+    so the code stays flat however deeply the tree is nested.
+    """
+
+    def __init__(self, convert: Optional[Callable] = None):
+        self.convert = convert
+        self.lines: List[str] = []
+        self.variables: Dict[str, str] = {}
+        self.constants: Dict[str, object] = {}
+
+    def assign(self, code: str) -> str:
+        """Add code computing a temporary, and return its name"""
+        name = f"_t{len(self.lines)}"
+        self.lines.append(f"{name} = {code}")
+        return name
+
+    def variable(self, name: str) -> str:
+        """Local name holding the value of variable name"""
+        if name not in self.variables:
+            self.variables[name] = f"_v{len(self.variables)}"
+        return self.variables[name]
+
+    def constant(self, value) -> str:
+        """Name for a constant that has no literal form, like a
+        float inf, which is passed in as a global instead.
+        """
+        name = f"_c{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    def function(self, result: str) -> Callable:
+        """Build the function returning the value of result"""
+        src = ["def _compiled(*_args, **_kw):",
+               "    _env = _args[0] if _args else _kw"]
+        if self.variables:
+            src.append("    try:")
+            for var, local in self.variables.items():
+                src.append(f"        {local} = _env[{var!r}]")
+            src.append("    except KeyError as e:")
+            src.append("        raise UndefinedVariable(")
+            src.append("            f'{e.args[0]} has not been assigned"
+                       " a value') from None")
+        src.extend("    " + line for line in self.lines)
+        src.append(f"    return {result}")
+        source = "\n".join(src)
+        namespace = dict(self.constants, UndefinedVariable=UndefinedVariable)
+        exec(compile(source, "<expr>", "exec"), namespace)
+        function = namespace["_compiled"]
+        function.variables = tuple(self.variables)
+        function.source = source
+        return function
@@ -0,0 +1,146 @@
+"""
+A queue of background jobs, run by a pool of worker threads.
+
+Used to compute results outside of the request that asks for
+them: the upload submits a job and returns at once, and later
+requests look up the job to see how it is doing.
+
+Jobs are identified by a key; submitting a key that is already
+queued or running returns the existing job instead of adding a
+second one.  The queue has a fixed length, and submit raises
+QueueFull rather than wait when it is full, so callers can tell
+clients to come back later instead of piling up work.
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from lru import LRUCache
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted to a full queue"""
+    pass
+
+
+class Job(object):
+    """One piece of work and, once it has run, its outcome:
+    result if it is DONE, or error describing why it FAILED, and
+    finished_at, the time.monotonic() when it finished.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the job is done or failed.  Returns false
+        if it still hasn't finished after timeout seconds.
+        """
+        return self._finished.wait(timeout)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """The job's status, for reporting to clients"""
+        outcome = {"status": self.status}
+        if self.status == DONE:
+            outcome["result"] = self.result
+        elif self.status == FAILED:
+            outcome["error"] = self.error
+        return outcome
+
+
+class JobQueue(object):
+    """Runs work(key, *args) for each job submitted, in one of
+    workers threads.  At most max_queued jobs wait to run, and
+    the last history finished jobs are kept for get().
+    """
+
+    def __init__(self, work: Callable[..., Any], workers: int = 2,
+                 max_queued: int = 64, history: int = 1024):
+        self.work = work
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._active: Dict[str, Job] = {}
+        self._finished = LRUCache(capacity=history)
+        self._lock = threading.RLock()
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key: str, *args: Any) -> Job:
+        """Queue work(key, *args), unless a job for key is already
+        queued or running, in which case that job is returned.
+        """
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job
+            job = Job(key)
+            try:
+                self._queue.put_nowait((job, args))
+            except queue.Full:
+                raise QueueFull(
+                    f"{self._queue.maxsize} jobs already waiting") from None
+            self._active[key] = job
+            return job
+
+    def submit_many(self, items: List[Tuple[str, tuple]]) -> List[Job]:
+        """Submit each (key, args) of items, all or none: raises
+        QueueFull, queueing nothing, unless there is room for
+        every job that isn't already queued or running.
+        """
+        with self._lock:
+            new = {key for key, _ in items if key not in self._active}
+            room = self._queue.maxsize - self._queue.qsize()
+            if self._queue.maxsize > 0 and len(new) > room:
+                raise QueueFull(f"No room for {len(new)} more jobs")
+            # Only this lock's holder adds to the queue, so there
+            # is still room for them all
+            return [self.submit(key, *args) for key, args in items]
+
+    def get(self, key: str) -> Optional[Job]:
+        """The current or most recent job for key, if any"""
+        with self._lock:
+            job = self._active.get(key)
+        return job or self._finished.get(key, None)
+
+    def pending(self) -> int:
+        """The number of jobs waiting to run"""
+        return self._queue.qsize()
+
+    def shutdown(self):
+        """Finish the jobs already queued, then stop the workers"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, args = item
+            job.status = RUNNING
+            try:
+                job.result = self.work(job.key, *args)
+                job.finished_at = time.monotonic()
+                job.status = DONE
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                job.finished_at = time.monotonic()
+                job.status = FAILED
+            with self._lock:
+                del self._active[job.key]
+                self._finished.put(job.key, job)
+            job._finished.set()
@@ -19,7 +19,8 @@ Beware 5-3 can read as '5' followed by '-3'; write it
 as 5 - 3.
 """
 import io
-from typing import Sequence
+from collections import deque
+from typing import Iterable, Iterator, Optional, Sequence
 
 # We use regular expressions (re) for the patterns that
 # match lexemes
@@ -29,10 +30,7 @@ import re
 # a finite set of values.
 from enum import Enum
 
-import logging
-logging.basicConfig()
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
+import tracing
 
 
 # To the extent possible, we would like to describe
@@ -87,6 +85,22 @@ def all_token_re() -> str:
 TOKENS_PAT = re.compile(all_token_re())
 
 
+def all_token_named_re() -> str:
+    """Like all_token_re, but each token pattern P is enclosed in a
+    named group (?P<NAME>P), where NAME is the TokenCat member name.
+    A match then tells us its category directly through m.lastgroup,
+    so we don't need to classify the word again afterward.
+    """
+    return "|".join([f"(?P<{cat.name}>{cat.value})" for cat in TokenCat])
+
+
+TOKENS_NAMED_PAT = re.compile(all_token_named_re())
+
+# Group name -> category, so finding the category of a match
+# is one dictionary lookup.
+_KIND_BY_GROUP = {cat.name: cat for cat in TokenCat}
+
+
 class LexicalError(Exception):
     """Raised when we can't extract tokens from the input"""
     pass
@@ -119,65 +133,122 @@ class TokenStream(object):
            token = stream.take()     # Removes token from front of stream
            lookahead = stream.peek() # Returns token without removing it
            # Do something with the token
+
+    Tokens are produced lazily: the file is read in chunks of
+    at most chunk_size characters, and only as far as needed to
+    answer peek() or take(), so very long lines, large files and
+    socket files (socket.makefile()) are never held in memory
+    as a whole.  Looked-ahead tokens wait in a deque.
     """
 
-    def __init__(self, f: io.IOBase):
+    def __init__(self, f: io.IOBase, chunk_size: int = 8192):
         self.file = f
-        self.tokens = []
-        self._check_fill()
-        log.debug("Tokens: {}".format(self.tokens))
+        self.chunk_size = chunk_size
+        self._source = self._read_tokens()
+        self._buffer = deque()
+
+    @classmethod
+    def from_tokens(cls, tokens: Iterable[Token]) -> "TokenStream":
+        """A stream over tokens that have already been lexed."""
+        stream = cls(io.StringIO())
+        stream._source = iter(tokens)
+        return stream
 
     def __str__(self) -> str:
-        return "[{}]".format(self.tokens.__repr__())
-
-    def _check_fill(self):
-        while len(self.tokens) == 0:
-            # We could read more than one line before hitting
-            # a token, but the loop will be broken if we
-            # hit end of file
-            line = self.file.readline()
-            if len(line) == 0:
-                # End of file, leave zero tokens in buffer
-                break
-            self.tokens = lex(line.strip())
-            log.debug("Refilled, tokens: {}".format(self.tokens))
-            # Note this might also leave zero tokens in buffer,
-            # but in that case outer while loop will attempt
-            # to refill it until we either get some tokens
-            # or hit end of file
+        return "[{}]".format(list(self._buffer).__repr__())
+
+    def _read_tokens(self) -> Iterator[Token]:
+        pending = ""
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            at_eof = len(chunk) == 0
+            text = pending + chunk
+            pos = 0
+            for m in TOKENS_NAMED_PAT.finditer(text):
+                if m.end() == len(text) and not at_eof:
+                    # The token may continue in the next chunk
+                    # (e.g., a long INT), so rescan it from there.
+                    break
+                pos = m.end()
+                token = _token_from_match(m)
+                if token is not None:
+                    yield token
+            if at_eof:
+                return
+            pending = text[pos:]
+
+    def _fill(self, n: int) -> bool:
+        """Buffer at least n tokens; False if the input ends first"""
+        buffer = self._buffer
+        while len(buffer) < n:
+            token = next(self._source, None)
+            if token is None:
+                return False
+            buffer.append(token)
+        return True
 
     def has_more(self) -> bool:
         """True if there are more tokens in the stream"""
-        self._check_fill()
-        return len(self.tokens) > 0
-
-    def peek(self) -> Token:
-        """Examine next token without consuming it. """
-        self._check_fill()
-        if len(self.tokens) > 0:
-            token = self.tokens[0]
-        else:
-            token = END
-        return token
+        return len(self._buffer) > 0 or self._fill(1)
+
+    def peek(self, n: int = 0) -> Token:
+        """Examine the token n places ahead (default: the next
+        token) without consuming anything.
+        """
+        if n < len(self._buffer) or self._fill(n + 1):
+            return self._buffer[n]
+        return END
 
     def take(self) -> Token:
         """Consume next token"""
-        self._check_fill()
-        if len(self.tokens) > 0:
-            token = self.tokens.pop(0)
-        else:
-            token = END
-        return token
+        if self._buffer:
+            return self._buffer.popleft()
+        return next(self._source, END)
 
 
 def lex(s: str) -> Sequence[Token]:
     """Break string into a list of Token objects"""
+    return list(iter_tokens(s))
+
+
+def iter_tokens(s: str) -> Iterator[Token]:
+    """Generate the Token objects of a string in a single scan.
+    Each match of TOKENS_NAMED_PAT is already classified by the
+    name of the group that matched it.
+    """
+    for m in TOKENS_NAMED_PAT.finditer(s):
+        token = _token_from_match(m)
+        if token is not None:
+            yield token
+
+
+def _token_from_match(m: "re.Match") -> Optional[Token]:
+    """Token for one match of TOKENS_NAMED_PAT, or None if
+    it should be skipped (whitespace and comments).
+    """
+    kind = _KIND_BY_GROUP[m.lastgroup]
+    if kind is TokenCat.ignore:
+        return None
+    if kind is TokenCat.error:
+        raise LexicalError(f"Unrecognized character '{m.group()}'")
+    token = Token(m.group(), kind)
+    if tracing.ENABLED:
+        tracing.event("lex", "token", token=token)
+    return token
+
+
+def lex_reference(s: str) -> Sequence[Token]:
+    """The original two-step lexer: find all the words, then
+    classify each one by trying every pattern in turn.  Slow,
+    but kept as the reference that lex() is tested against.
+    """
     words = TOKENS_PAT.findall(s)
     tokens = []
     for word in words:
         token = classify(word)
         if token.kind == TokenCat.ignore:
-            log.debug(f"Skipping {token}")
+            if tracing.ENABLED:
+                tracing.event("lex", "skip", token=token)
             continue
         tokens.append(token)
     return tokens
@@ -187,12 +258,11 @@ def classify(word: str) -> Token:
     """Convert a textual token into a Token object
     with a value and category.
     """
-    log.debug(f"Classifying token '{word}")
     for kind in TokenCat:
-        log.debug(f"Checking '{word}' for token class '{kind}'")
         pattern = kind.value
         if re.fullmatch(pattern, word):
-            log.debug(f"Classified as {kind}")
+            if tracing.ENABLED:
+                tracing.event("lex", "classify", word=word, kind=kind)
             if kind.name == "error":
                 raise LexicalError(f"Unrecognized character '{word}'")
             return Token(word, kind)
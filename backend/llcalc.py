@@ -2,17 +2,20 @@
 An LL parser for the calculator.
 """
 
-from lex import TokenStream, TokenCat
+from lex import TokenStream, TokenCat, lex
+from lru import LRUCache
 import expr
-import io
-from typing import TextIO
-
-import logging
-
-logging.basicConfig(filename="parser.log")
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-log.propagate = False
+import metrics
+import tracing
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, \
+    TextIO
 
 
 class InputError(Exception):
@@ -60,7 +63,8 @@ def _program(stream: TokenStream) -> expr.Expr:
     calculator.  Later we will parse a sequence of
     statements in programs.
     """
-    log.debug(f"Parsing program from token {stream.peek()}")
+    if tracing.ENABLED:
+        tracing.event("parse", "program", token=stream.peek())
     return _stmt(stream)
 
 
@@ -81,12 +85,13 @@ def _expr(stream: TokenStream) -> expr.Expr:
     """
     expr ::= term { ('+'|'-') term }
     """
-    log.debug(f"parsing sum starting from token {stream.peek()}")
+    if tracing.ENABLED:
+        tracing.event("parse", "expr", token=stream.peek())
     left = _term(stream)
-    log.debug(f"sum begins with {left}")
     while stream.peek().value in ["+", "-"]:
         op = stream.take()
-        log.debug(f"expr addition op {op}")
+        if tracing.ENABLED:
+            tracing.event("parse", "op", token=op)
         right = _term(stream)
         if op.value == "+":
             left = expr.Plus(left, right)
@@ -99,10 +104,13 @@ def _expr(stream: TokenStream) -> expr.Expr:
 
 def _term(stream: TokenStream) -> expr.Expr:
     """term ::= primary { ('*'|'/')  primary }"""
+    if tracing.ENABLED:
+        tracing.event("parse", "term", token=stream.peek())
     left = _secondary(stream)
-    log.debug(f"term starts with {left}")
     while stream.peek().value in ["*", "/"]:
         op = stream.take()
+        if tracing.ENABLED:
+            tracing.event("parse", "op", token=op)
         right = _secondary(stream)
         if op.value == "*":
             left = expr.Times(left, right)
@@ -115,10 +123,13 @@ def _term(stream: TokenStream) -> expr.Expr:
 
 def _secondary(stream: TokenStream) -> expr.Expr:
     """term ::= secondary { ('^'|'|')  secondary }"""
+    if tracing.ENABLED:
+        tracing.event("parse", "secondary", token=stream.peek())
     left = _primary(stream)
-    log.debug(f"term starts with {left}")
     while stream.peek().value in ["^", "|"]:
         op = stream.take()
+        if tracing.ENABLED:
+            tracing.event("parse", "op", token=op)
         right = _primary(stream)
         if op.value == "^":
             left = expr.Raise(left, right)
@@ -131,13 +142,12 @@ def _secondary(stream: TokenStream) -> expr.Expr:
 
 def _primary(stream: TokenStream) -> expr.Expr:
     """Constants, Variables, and parenthesized expressions"""
-    log.debug(f"Parsing primary with starting token {stream.peek()}")
     token = stream.take()
+    if tracing.ENABLED:
+        tracing.event("parse", "primary", token=token)
     if token.kind is TokenCat.INT:
-        log.debug(f"Returning Const node from token {token}")
         return expr.Const(int(token.value))
     elif token.kind is TokenCat.VAR:
-        log.debug(f"Variable {token.value}")
         return expr.Var(token.value)
     elif token.kind is TokenCat.LPAREN:
         nested = _expr(stream)
@@ -147,27 +157,230 @@ def _primary(stream: TokenStream) -> expr.Expr:
         raise InputError(f"Confused about {token} in expression")
 
 
+###
+# Parse cache
+###
+#
+# The same few equations come in over and over, so calc()
+# keeps the trees it has parsed, keyed on the normalised text.
+# Size and policy can be set with LLCALC_PARSE_CACHE_SIZE and
+# LLCALC_PARSE_CACHE_POLICY ("lru" or "fifo").
+#
+
+PARSE_CACHE = LRUCache(
+    capacity=int(os.environ.get("LLCALC_PARSE_CACHE_SIZE", 256)),
+    policy=os.environ.get("LLCALC_PARSE_CACHE_POLICY", "lru"))
+
+
+def configure_parse_cache(capacity: int = 256, policy: str = "lru"):
+    """Replace the parse cache with an empty one of the given
+    capacity and eviction policy.  Capacity 0 disables caching.
+    """
+    global PARSE_CACHE
+    PARSE_CACHE = LRUCache(capacity=capacity, policy=policy)
+
+
+def parse_cache_stats() -> Dict[str, int]:
+    """Hit, miss and eviction counts of the parse cache"""
+    return PARSE_CACHE.stats()
+
+
+def _normalise(text: str) -> str:
+    """Collapse runs of blanks within each line and drop blank
+    lines, which never changes how the text is tokenised.
+    Line breaks are kept since they end comments.
+    """
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def parse_cached(text: str, budget: expr.Budget = None) -> expr.Expr:
+    """Parse and simplify text, reusing the tree from an earlier
+    parse of the same (normalised) text when there is one.  A new
+    tree is checked against the size limits of budget before it
+    is simplified, since folding constants is work too.
+    """
+    key = _normalise(text)
+    tree = PARSE_CACHE.get(key, None)
+    if tracing.ENABLED:
+        tracing.event("calc", "parse_cache", text=key, hit=tree is not None)
+    if tree is None:
+        # Lex up front rather than on demand, so the two stages
+        # are timed separately
+        with metrics.stage("lex"):
+            tokens = lex(key)
+        with metrics.stage("parse"):
+            tree = _program(TokenStream.from_tokens(tokens))
+            if budget is not None:
+                budget.check_tree(tree)
+            tree = expr.simplify(tree)
+        PARSE_CACHE.put(key, tree)
+    return tree
+
+
+metrics.register_cache("parse", lambda: PARSE_CACHE.stats())
+
+
+def _budget(ctx: expr.Context):
+    return ctx.budget if ctx is not None else None
+
+
+def _evaluate(exp: expr.Expr, ctx: expr.Context) -> str:
+    """The value of exp in ctx, as calc returns it.  Evaluated
+    with an explicit stack, so deep generated expressions don't
+    hit the recursion limit.
+    """
+    with metrics.stage("eval"):
+        return str(exp.eval_stack(ctx).value)
+
+
 ###
 # Calculator
 ###
 
-def calc(text: str):
-    """Parse and execute a single line"""
+def calc_value(text: str, ctx: expr.Context = None) -> str:
+    """Parse and execute a single line, with variables in ctx
+    (by default the global expr.ENV), raising any error
+    """
+    exp = parse_cached(text, _budget(ctx))
+#    print(f"{exp} => {exp.eval()}")
+    return _evaluate(exp, ctx)
+
+
+def calc(text: str, ctx: expr.Context = None):
+    """Parse and execute a single line, with variables in ctx
+    (by default the global expr.ENV).  Errors are printed, and
+    give None.
+    """
     try:
-        exp = parse(io.StringIO(text))
-#        print(f"{exp} => {exp.eval()}")
-        return str(exp.eval().value)
+        return calc_value(text, ctx)
     except Exception as e:
         print(f"Error: {e}")
 
 
+class CalcResult(NamedTuple):
+    """Outcome of one calculation in a batch: value is the
+    result as calc() would return it, or None if the calculation
+    failed, in which case error describes what went wrong.
+    """
+    text: str
+    value: Optional[str]
+    error: Optional[str] = None
+
+
+def _calc_in(text: str, ctx: expr.Context) -> CalcResult:
+    """Calculate text in ctx, reporting rather than raising errors"""
+    try:
+        return CalcResult(text, calc_value(text, ctx))
+    except Exception as e:
+        return CalcResult(text, None, f"{type(e).__name__}: {e}")
+
+
+def _calc_one(text: str) -> CalcResult:
+    """Calculate text in a fresh context"""
+    return _calc_in(text, expr.Context())
+
+
+def _calc_chunk(texts: List[str]) -> List[CalcResult]:
+    return [_calc_one(text) for text in texts]
+
+
+def calc_many(texts: Iterable[str], workers: Optional[int] = None,
+              chunksize: int = 64) -> Iterator[CalcResult]:
+    """Calculate each of texts, yielding a CalcResult for each
+    in input order.  Every text is evaluated in its own empty
+    environment, so results don't depend on how the work is
+    split up.  Errors are reported in the results, not raised.
+
+    The texts are sent in chunks to a pool of worker processes
+    (os.cpu_count() of them by default).  texts is consumed
+    lazily and only a few chunks per worker are in flight at a
+    time, so arbitrarily long inputs run in bounded memory.
+    With workers=1 everything runs in this process.
+    """
+    texts = iter(texts)
+    chunks = iter(lambda: list(islice(texts, chunksize)), [])
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in chunks:
+            yield from _calc_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_calc_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class BatchStats(NamedTuple):
+    """Totals for one run_batch"""
+    statements: int
+    errors: int
+    seconds: float
+
+
+def run_batch(infile: TextIO, outfile: TextIO,
+              ctx: expr.Context = None) -> BatchStats:
+    """Calculate each line of infile as a statement, in one shared
+    context, writing one line of output per statement as it goes:
+    the value, or "Error: ..." if it failed.  Blank lines and
+    comment lines are skipped.  Lines are read one at a time, so
+    memory use doesn't grow with the size of the input.
+    """
+    ctx = ctx if ctx is not None else expr.Context()
+    statements = errors = 0
+    start = time.perf_counter()
+    for line in infile:
+        text = line.strip()
+        if not text or text.startswith("#"):
+            continue
+        result = _calc_in(text, ctx)
+        statements += 1
+        if result.error is None:
+            outfile.write(result.value + "\n")
+        else:
+            errors += 1
+            outfile.write(f"Error: {result.error}\n")
+    return BatchStats(statements, errors, time.perf_counter() - start)
+
+
 def llcalc():
     """Interactive calculator interface."""
-    txt = "16 | 2"
-    x = calc(txt)
-    input()
-    print(txt, " => ", x)
+    ctx = expr.Context()
+    while True:
+        try:
+            txt = input("> ")
+        except EOFError:
+            print()
+            return
+        if txt.strip():
+            result = _calc_in(txt, ctx)
+            print(txt, " => ", result.value or f"Error: {result.error}")
+
+
+def main(argv: List[str] = None):
+    """Command line: with a file argument, or with input piped in,
+    calculate statements in batch; otherwise run interactively.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("file", nargs="?", type=argparse.FileType("r"),
+                        help="file of statements, one per line "
+                             "('-' for standard input)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't report throughput when done")
+    args = parser.parse_args(argv)
+    if args.file is None and sys.stdin.isatty():
+        llcalc()
+        return
+    stats = run_batch(args.file or sys.stdin, sys.stdout)
+    if not args.quiet:
+        rate = stats.statements / stats.seconds if stats.seconds else 0
+        print(f"{stats.statements} statements, {stats.errors} errors "
+              f"in {stats.seconds:.3f}s ({rate:.0f}/s)", file=sys.stderr)
 
 
 if __name__ == "__main__":
-    llcalc()
+    main()
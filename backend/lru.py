@@ -0,0 +1,87 @@
+"""
+A small bounded cache, safe to share between threads.
+
+Used for caching parsed expressions in llcalc.  Entries are
+evicted either least-recently-used first ("lru") or in the
+order they were added ("fifo").  Hit, miss and eviction counts
+are kept so callers can export them.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+POLICIES = ("lru", "fifo")
+
+# Returned by get() when the key is not present, so that None
+# can be cached like any other value.
+MISSING = object()
+
+
+class LRUCache(object):
+    """Maps keys to values, holding at most capacity entries."""
+
+    def __init__(self, capacity: int = 256, policy: str = "lru"):
+        if capacity < 0:
+            raise ValueError(f"Cache capacity must be >= 0, not {capacity}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy '{policy}'")
+        self.capacity = capacity
+        self.policy = policy
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """The value cached for key, or default if there is none."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.policy == "lru":
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Cache value for key, evicting old entries if full."""
+        if self.capacity == 0:
+            return
+        with self._lock:
+            if key in self._entries and self.policy == "lru":
+                self._entries.move_to_end(key)
+            self._entries[key] = value
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: Hashable):
+        """Remove key from the cache if it is there."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Snapshot of the cache counters."""
+        with self._lock:
+            return {"size": len(self._entries),
+                    "capacity": self.capacity,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
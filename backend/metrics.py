@@ -0,0 +1,225 @@
+"""
+Counters and latency histograms, served as Prometheus text.
+
+Metrics are created once at module level and updated as work
+happens, e.g.
+
+    UPLOADS = metrics.Counter("uploads_total", "Files received")
+    ...
+    UPLOADS.inc()
+
+The stages of handling an image are timed, and their failures
+counted, with
+
+    with metrics.stage("parse"):
+        tree = parse(...)
+
+render() returns every metric in the Prometheus text exposition
+format, for the /metrics route.  Updating a metric takes a lock
+and a dict lookup, so it is cheap enough to leave on everywhere.
+
+Values kept elsewhere, like the hit counts of the caches, are
+exported by registering a function that reports them when the
+metrics are rendered (see register_cache).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Upper bounds, in seconds, of the default histogram buckets.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics: List["_Metric"] = []
+_caches: Dict[str, Callable[[], Dict[str, int]]] = {}
+
+
+class _Metric(object):
+    """A named metric with zero or more labels.  Each combination
+    of label values is tracked separately.
+    """
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, "
+                             f"not {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{label}="{_escape(value)}"'
+                 for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def clear(self):
+        """Forget all recorded values"""
+        with _lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """A count that only goes up, like the number of errors"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with _lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}{self._label_text(key)} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    """Counts of observations (usually durations in seconds) that
+    fall in each bucket, with their total and their count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with _lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how long the with block takes, in seconds,
+        whether or not it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """The number of observations"""
+        with _lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[:-1]) if counts else 0
+
+    def _samples(self, key, counts) -> List[str]:
+        lines = []
+        total = 0
+        bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, counts):
+            total += count
+            labels = self._label_text(key, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = self._label_text(key)
+        lines.append(f"{self.name}_sum{labels} {_number(counts[-1])}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the with block in STAGE_SECONDS, and count any
+    exception it raises in ERRORS, both labelled stage=name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.inc(stage=name, error=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def register_cache(cache: str, stats: Callable[[], Dict[str, int]]):
+    """Export the counters of a cache, given a function returning
+    its stats() (see lru.LRUCache), read afresh on each render.
+    """
+    with _lock:
+        _caches[cache] = stats
+
+
+def _render_caches() -> List[str]:
+    with _lock:
+        caches = sorted(_caches.items())
+    stats = [(cache, report()) for cache, report in caches]
+    lines = []
+    for field, kind, help in [
+            ("hits", "counter", "Lookups that found an entry"),
+            ("misses", "counter", "Lookups that found no entry"),
+            ("evictions", "counter", "Entries evicted to make room"),
+            ("size", "gauge", "Entries currently cached")]:
+        name = f"cache_{field}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache, values in stats:
+            lines.append(f'{name}{{cache="{_escape(cache)}"}} '
+                         f'{values[field]}')
+    return lines
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text format"""
+    with _lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    if _caches:
+        lines.extend(_render_caches())
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics shared by the app and the calculator
+STAGE_SECONDS = Histogram(
+    "stage_seconds",
+    "Time spent in each stage of handling an image",
+    labels=("stage",))
+ERRORS = Counter(
+    "errors_total",
+    "Failures in each stage, by exception type",
+    labels=("stage", "error"))
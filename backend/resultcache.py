@@ -0,0 +1,150 @@
+"""
+Cache of computed results, keyed by upload hash.
+
+Results are held in memory in an LRUCache and, if a directory
+is given, also written to disk there so that they survive a
+restart.  Concurrent requests for a result that isn't cached yet
+are coalesced: the first computes it and the rest wait for its
+answer, so each result is computed at most once at a time.
+"""
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Optional
+
+from lru import MISSING, LRUCache
+
+
+class _Flight(object):
+    """A computation in progress, which other requests wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+class ResultCache(object):
+    """Maps keys (upload hashes) to results, computing each one
+    on first use.  Results must be JSON-serialisable if a
+    directory is given.
+    """
+
+    def __init__(self, capacity: int = 1024, directory: Optional[str] = None):
+        self.memory = LRUCache(capacity=capacity)
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, compute: Callable[[], Any]) -> Any:
+        """The result for key, from the cache or else compute().
+        If compute raises, the exception is passed to every
+        request waiting on it and nothing is cached.
+        """
+        value = self.memory.get(key)
+        if value is not MISSING:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            value = self._load(key)
+            if value is MISSING:
+                value = compute()
+                self._store(key, value, flight)
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def lookup(self, key: str) -> Any:
+        """The cached result for key, or MISSING if there is none.
+        Never computes anything.
+        """
+        value = self.memory.get(key)
+        if value is MISSING:
+            value = self._load(key)
+        return value
+
+    def invalidate(self, key: str):
+        """Forget the result for key, e.g. because the upload was
+        replaced.  A computation of it already under way still
+        answers the requests waiting on it, but isn't cached.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.stale = True
+            self.memory.discard(key)
+        self._remove(key)
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of the in-memory cache"""
+        return self.memory.stats()
+
+    def _path(self, key: str) -> Optional[str]:
+        # Only plain names go to disk, so a key can't point
+        # outside the directory
+        if self.directory and key.isalnum():
+            return os.path.join(self.directory, key + ".json")
+        return None
+
+    def _load(self, key: str) -> Any:
+        path = self._path(key)
+        if not path:
+            return MISSING
+        try:
+            with open(path) as f:
+                value = json.load(f)["result"]
+        except (OSError, ValueError, KeyError):
+            return MISSING
+        self.memory.put(key, value)
+        return value
+
+    def _store(self, key: str, value: Any, flight: _Flight):
+        # Only the stale flag needs the lock: writing to disk
+        # outside it keeps other keys from waiting on the disk
+        with self._lock:
+            if flight.stale:
+                return
+            self.memory.put(key, value)
+        path = self._path(key)
+        if not path:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"result": value}, f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            stale = flight.stale
+        if stale:
+            # Invalidated while it was being written
+            self._remove(key)
+
+    def _remove(self, key: str):
+        path = self._path(key)
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
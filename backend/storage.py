@@ -0,0 +1,84 @@
+"""
+Content-addressed storage for uploaded images.
+
+Each upload is stored under a hash of its bytes, so the same
+image uploaded twice (under any name) is stored once and has
+one key, and different images never overwrite each other.
+
+The bytes are hashed as they are copied to a temporary file in
+the upload folder, a chunk at a time, so memory use doesn't
+depend on the size of the upload.  Once the key is known the
+file is renamed into place, or dropped if an identical upload is
+already stored.  An upload bigger than the limit given is
+abandoned as soon as it passes the limit.
+"""
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO, NamedTuple, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+# Keys are this many hex digits of the SHA-256 of the content,
+# the same length as the filename hashes used before.
+HASH_LENGTH = 15
+
+_TEMP_PREFIX = ".upload-"
+
+
+class TooLarge(Exception):
+    """Raised when an upload is bigger than allowed"""
+    pass
+
+
+class Stored(NamedTuple):
+    """Where an upload was stored"""
+    key: str
+    path: str
+    size: int
+    duplicate: bool
+
+
+def save(stream: BinaryIO, folder: str,
+         max_size: Optional[int] = None) -> Stored:
+    """Store the bytes read from stream in folder, returning the
+    key they are stored under.  duplicate is true if the same
+    content was already stored, in which case nothing is added.
+    Raises TooLarge, storing nothing, if stream has more than
+    max_size bytes.
+    """
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=_TEMP_PREFIX)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise TooLarge(f"Upload is over {max_size} bytes")
+                digest.update(chunk)
+                out.write(chunk)
+        key = digest.hexdigest()[:HASH_LENGTH]
+        path = os.path.join(folder, key)
+        if os.path.exists(path):
+            os.remove(tmp)
+            return Stored(key, path, size, True)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return Stored(key, path, size, False)
+
+
+def lookup(folder: str, key: str) -> Optional[str]:
+    """The path of the upload stored under key, or None if there
+    isn't one.  Anything that isn't a key is not found, so a key
+    taken from a URL can't name any other file.
+    """
+    if len(key) != HASH_LENGTH or not all(c in "0123456789abcdef"
+                                          for c in key):
+        return None
+    path = os.path.join(folder, key)
+    return path if os.path.isfile(path) else None
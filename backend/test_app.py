@@ -0,0 +1,205 @@
+"""Test cases for app.py, run only if Flask is installed"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import jobs
+from lru import MISSING
+from resultcache import ResultCache
+
+try:
+    from werkzeug.exceptions import RequestEntityTooLarge
+    import app
+except ImportError:
+    app = None
+
+
+def upload(data, name="image.png"):
+    return {"file": (io.BytesIO(data), name)}
+
+
+@unittest.skipUnless(app, "Flask isn't installed")
+class TestApp(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp(prefix="test-app-")
+        self.addCleanup(shutil.rmtree, folder)
+        self.patch(mock.patch.dict(os.environ,
+                                   UPLOAD_FOLDER=folder + os.sep))
+        self.patch(mock.patch.object(app, "RESULTS", ResultCache()))
+        self.compute = self.patch(
+            mock.patch.object(app, "image_compute", return_value="x = 6"))
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.client = app.app.test_client()
+
+    def patch(self, patcher):
+        value = patcher.start()
+        self.addCleanup(patcher.stop)
+        return value
+
+    def blocked_queue(self, **kwargs):
+        """A job queue like the app's whose jobs wait for release"""
+        run = app.JOBS.work
+
+        def work(key, path):
+            self.started.set()
+            self.release.wait(5)
+            return run(key, path)
+
+        q = jobs.JobQueue(work, **kwargs)
+        self.addCleanup(q.shutdown)
+        self.addCleanup(self.release.set)
+        self.patch(mock.patch.object(app, "JOBS", q))
+        return q
+
+    def post(self, data, name="image.png"):
+        response = self.client.post("/uploader", data=upload(data, name))
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def finish(self, key):
+        self.assertTrue(app.JOBS.get(key).wait(5))
+
+    def test_metrics(self):
+        before = app.REQUESTS.value(route="/uploader", status="200")
+        self.client.get("/uploader")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn("# TYPE http_requests_total counter", text)
+        self.assertIn("# TYPE http_request_seconds histogram", text)
+        self.assertIn('cache_hits_total{cache="result"}', text)
+        self.assertEqual(app.REQUESTS.value(route="/uploader", status="200"),
+                         before + 1)
+
+    def test_content_addressed(self):
+        data = b"an image of 2 + 4 = x"
+        key = self.post(data, "a.png")
+        self.assertEqual(key, hashlib.sha256(data).hexdigest()[:15])
+        self.assertEqual(self.post(data, "b.png"), key)
+        response = self.client.post(
+            "/uploader", data=data, content_type="application/octet-stream")
+        self.assertEqual(response.get_data(as_text=True), key)
+        self.assertNotEqual(self.post(b"another image"), key)
+        self.assertEqual(self.client.get("/0123456789abcde").data, b"None")
+
+    def test_cached(self):
+        key = self.post(b"cached")
+        self.finish(key)
+        for _ in range(3):
+            response = self.client.get(f"/{key}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(as_text=True), "x = 6")
+        self.compute.assert_called_once()
+
+    def test_pending(self):
+        self.blocked_queue(workers=1)
+        key = self.post(b"pending")
+        response = self.client.get(f"/{key}")
+        self.assertEqual(response.status_code, 202)
+        self.assertIn(response.get_json()["status"],
+                      (jobs.QUEUED, jobs.RUNNING))
+        self.release.set()
+        self.finish(key)
+        response = self.client.get(f"/{key}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), "x = 6")
+
+    def test_failed(self):
+        self.compute.side_effect = ZeroDivisionError("division by zero")
+        key = self.post(b"failing")
+        self.finish(key)
+        response = self.client.get(f"/{key}")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json(), {
+            "status": jobs.FAILED,
+            "error": "ZeroDivisionError: division by zero"})
+        self.assertIs(app.RESULTS.lookup(key), MISSING)
+
+    def test_retry_failed(self):
+        self.compute.side_effect = [ZeroDivisionError("transient"), "x = 6"]
+        key = self.post(b"flaky")
+        self.finish(key)
+        self.assertEqual(self.client.get(f"/{key}").status_code, 500)
+        # Tried again once it has been failed for long enough
+        self.patch(mock.patch.object(app, "RETRY_FAILED_AFTER", 0))
+        self.assertIn(self.client.get(f"/{key}").status_code, (200, 202))
+        self.finish(key)
+        response = self.client.get(f"/{key}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), "x = 6")
+
+    def test_busy(self):
+        q = self.blocked_queue(workers=1, max_queued=1)
+        q.submit("running", None)
+        self.started.wait(5)
+        q.submit("waiting", None)
+        response = self.client.post("/uploader", data=upload(b"busy"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "5")
+        response = self.client.post("/batch", data={"file": [
+            (io.BytesIO(b"one"), "1.png"), (io.BytesIO(b"two"), "2.png")]})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(q.pending(), 1)
+
+    def test_too_large(self):
+        self.patch(mock.patch.object(app, "MAX_UPLOAD_BYTES", 10))
+        response = self.client.post("/uploader", data=upload(b"x" * 100))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(os.listdir(os.environ["UPLOAD_FOLDER"]), [])
+        # Refused by length alone, before the body is read
+        self.patch(mock.patch.object(app, "UPLOAD_OVERHEAD", 0))
+        response = self.client.post("/uploader", data=b"x" * 100,
+                                    content_type="application/octet-stream")
+        self.assertEqual(response.status_code, 413)
+
+    def test_capped_input(self):
+        body = app.CappedInput(io.BytesIO(b"x" * 20), 10)
+        self.assertEqual(body.read(4), b"xxxx")
+        self.assertEqual(body.read(6), b"x" * 6)
+        with self.assertRaises(RequestEntityTooLarge):
+            body.read()
+        body = app.CappedInput(io.BytesIO(b"x" * 10), 10)
+        self.assertEqual(body.read(), b"x" * 10)
+        self.assertEqual(body.read(), b"")
+
+    def test_batch(self):
+        cached = self.post(b"one")
+        self.finish(cached)
+        self.compute.side_effect = ["x = 2", ZeroDivisionError("oops")]
+        response = self.client.post("/batch", data={"file": [
+            (io.BytesIO(b"one"), "1.png"),
+            (io.BytesIO(b"two"), "2.png"),
+            (io.BytesIO(b"three"), "3.png")]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line)
+                 for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line["index"] for line in lines], [0, 1, 2])
+        self.assertEqual([line["file"] for line in lines],
+                         ["1.png", "2.png", "3.png"])
+        self.assertEqual(lines[0], {"index": 0, "file": "1.png",
+                                    "hash": cached, "result": "x = 6"})
+        results = {line.get("result") for line in lines[1:]}
+        errors = {line.get("error") for line in lines[1:]}
+        self.assertEqual(results, {"x = 2", None})
+        self.assertEqual(errors, {"ZeroDivisionError: oops", None})
+        self.assertEqual(self.compute.call_count, 3)
+
+    def test_batch_limits(self):
+        self.assertEqual(self.client.post("/batch", data={}).status_code, 400)
+        self.patch(mock.patch.object(app, "MAX_BATCH_FILES", 1))
+        response = self.client.post("/batch", data={"file": [
+            (io.BytesIO(b"one"), "1.png"), (io.BytesIO(b"two"), "2.png")]})
+        self.assertEqual(response.status_code, 413)
+
+
+if __name__ == "__main__":
+    unittest.main()
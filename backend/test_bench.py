@@ -0,0 +1,29 @@
+"""Test cases for bench.py"""
+import unittest
+import bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run_benchmarks(["lex", "solve"], repeat=2,
+                                       min_time=0.001)
+        self.assertEqual(list(results["stages"]), ["lex", "solve"])
+        for stage in results["stages"].values():
+            self.assertGreater(stage["best_us"], 0)
+            self.assertLessEqual(stage["best_us"], stage["median_us"])
+
+    def test_compare(self):
+        def run(**times):
+            return {"stages": {name: {"best_us": t}
+                               for name, t in times.items()}}
+        baseline = run(lex=10.0, parse=20.0, eval=5.0)
+        self.assertEqual(bench.compare(run(lex=12.0, parse=26.0, calc=9.0),
+                                       baseline, threshold=0.25),
+                         [("parse", 20.0, 26.0)])
+        self.assertEqual(bench.compare(run(lex=12.0), baseline, 0.1),
+                         [("lex", 10.0, 12.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
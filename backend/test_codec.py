@@ -0,0 +1,68 @@
+"""Test cases for codec.py"""
+import io
+import pickle
+import unittest
+from codec import DecodeError, decode, encode
+from expr import *
+from llcalc import parse
+
+
+class TestCodec(unittest.TestCase):
+
+    def roundtrip(self, exp):
+        decoded = decode(encode(exp))
+        self.assertEqual(decoded, exp)
+        self.assertEqual(repr(decoded), repr(exp))
+        return decoded
+
+    def test_every_node(self):
+        x, y = Var("x"), Var("y")
+        self.roundtrip(Equals(
+            Plus(Minus(x, Const(3)), Times(y, Const(-4))),
+            Div(Raise(Abs(x), Const(2)), Root(Neg(y), Const(3)))))
+
+    def test_constants(self):
+        for value in [0, 1, -1, 63, -64, 64, 2 ** 70, -(3 ** 90),
+                      0.5, -1e300, float("inf"), 1 + 2j]:
+            with self.subTest(value=value):
+                decoded = decode(encode(Const(value)))
+                self.assertEqual(decoded.value, value)
+                self.assertIs(type(decoded.value), type(value))
+
+    def test_interns_names(self):
+        exp = Plus(Var("total"), Times(Var("total"), Var("total")))
+        data = encode(exp)
+        self.assertEqual(data.count(b"total"), 1)
+        self.assertIs(self.roundtrip(exp).left, Var("total"))
+
+    def test_parsed(self):
+        exp = parse(io.StringIO("(x_y + 12) * y ^ 2 / 16 | 2 = z"))
+        self.roundtrip(exp)
+        self.assertLess(len(encode(exp)), len(pickle.dumps(exp)))
+
+    def test_deep(self):
+        exp = Var("x")
+        for i in range(50000):
+            exp = Plus(exp, Const(i)) if i % 2 else Neg(exp)
+        self.assertEqual(decode(encode(exp)).eval_stack(Context({"x": Const(1)})),
+                         exp.eval_stack(Context({"x": Const(1)})))
+
+    def test_memoryview(self):
+        exp = Times(Var("a"), Const(7))
+        self.assertEqual(decode(memoryview(bytearray(encode(exp)))), exp)
+
+    def test_bad_input(self):
+        data = encode(Plus(Var("x"), Const(300)))
+        for bad in [b"", b"nope", data[:-1], data + b"\0",
+                    data[:4] + b"\x09", data[:-3] + bytes([99])]:
+            with self.subTest(data=bad):
+                with self.assertRaises(DecodeError):
+                    decode(bad)
+
+    def test_unknown_node(self):
+        with self.assertRaises(TypeError):
+            encode(Const("text"))
+
+
+if __name__ == "__main__":
+    unittest.main()
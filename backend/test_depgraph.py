@@ -0,0 +1,75 @@
+"""Test cases for depgraph.py"""
+import unittest
+import llcalc
+from depgraph import DependentContext
+from expr import *
+
+
+class TestDependentContext(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = DependentContext()
+
+    def calc(self, text):
+        return llcalc.calc(text, self.ctx)
+
+    def test_follows_inputs(self):
+        self.calc("x = 2")
+        self.calc("y = x * 10")
+        self.calc("z = y + x")
+        self.assertEqual(self.calc("z"), "22")
+        self.calc("x = 3")
+        self.assertEqual(self.ctx.stale, {"y", "z"})
+        self.assertEqual(self.calc("z"), "33")
+        self.assertEqual(self.ctx.recomputed, 2)
+
+    def test_only_used_dependents(self):
+        self.calc("a = 1")
+        self.calc("b = a + 1")
+        self.calc("c = a + 2")
+        self.calc("a = 5")
+        self.assertEqual(self.calc("b"), "6")
+        self.assertEqual(self.ctx.recomputed, 1)
+        self.assertIn("c", self.ctx.stale)
+
+    def test_solved_definition(self):
+        self.calc("w = 4")
+        self.calc("2 * v = w + 2")
+        self.calc("w = 10")
+        self.assertEqual(self.calc("v"), "6.0")
+
+    def test_redefine_drops_formula(self):
+        self.calc("x = 1")
+        self.calc("y = x + 1")
+        self.calc("y = 7")
+        self.calc("x = 100")
+        self.assertEqual(self.calc("y"), "7")
+
+    def test_failed_recompute_stays_stale(self):
+        self.calc("x = 1")
+        self.calc("y = 6 / x")
+        self.calc("x = 0")
+        self.assertIsNone(self.calc("y + 0"))
+        self.assertIsNone(self.calc("y"))
+        self.calc("x = 2")
+        self.assertEqual(self.calc("y"), "3.0")
+
+    def test_self_reference(self):
+        self.calc("x = 1")
+        self.calc("x = x + 1")
+        self.assertEqual(self.calc("x"), "2")
+        self.calc("y = x")
+        self.calc("x = y + 1")
+        # x gets a plain value, which y = x then follows
+        self.assertEqual(self.calc("x"), "3")
+        self.assertEqual(self.calc("y"), "3")
+
+    def test_define(self):
+        self.ctx.assign("p", Const(3))
+        self.ctx.define("q", Times(Var("p"), Var("p")))
+        self.ctx.assign("p", Const(4))
+        self.assertEqual(Var("q").eval(self.ctx), Const(16))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@
 Michal Young, 2020.01.17
 """
 import unittest
+from fractions import Fraction
+import expr
 from expr import *
 
 
@@ -298,6 +300,29 @@ class TestReverse(unittest.TestCase):
 
 class TestSolve(unittest.TestCase):
 
+    def test_neg(self):
+        exp = Equals(Neg(Plus(Var("v"), Const(1))), Const(5))
+        self.assertEqual(exp.eval(), Const(-6))
+
+    def test_abs(self):
+        with self.assertRaises(NotImplementedError):
+            Equals(Abs(Var("v")), Const(5)).eval()
+
+    def test_nested(self):
+        exp = Equals(Const(20),
+                     Times(Const(2), Minus(Const(13), Div(Var("v"), Const(4)))))
+        self.assertEqual(exp.eval(), Const(12.0))
+
+    def test_no_var(self):
+        with self.assertRaises(NotImplementedError):
+            Equals(Const(1), Plus(Const(1), Const(0))).eval()
+
+    def test_deep(self):
+        side = Var("v")
+        for i in range(20000):
+            side = Plus(Const(1), side) if i % 2 else Minus(side, Const(1))
+        self.assertEqual(Equals(Const(0), side).eval_stack(), Const(0))
+
     def test_solve_easy_right(self):
         v = Var("v")
         exp = Equals(v, Plus(Const(5), Const(2)))
@@ -319,5 +344,329 @@ class TestSolve(unittest.TestCase):
         self.assertEquals(exp.eval(), Const(16))
 
 
+class TestLinear(unittest.TestCase):
+
+    def test_both_sides(self):
+        exp = Equals(Plus(Var("x"), Const(2)), Times(Var("x"), Const(3)))
+        self.assertEqual(exp.eval(), Const(1))
+        self.assertEqual(Var("x").eval(), Const(1))
+
+    def test_same_side(self):
+        exp = Equals(Plus(Times(Const(2), Var("x")), Var("x")), Const(9))
+        self.assertEqual(exp.eval(), Const(3))
+
+    def test_fraction(self):
+        exp = Equals(Div(Minus(Var("x"), Const(1)), Const(3)),
+                     Neg(Var("x")))
+        self.assertEqual(exp.eval(), Const(0.25))
+
+    def test_no_solution(self):
+        exp = Equals(Plus(Var("x"), Const(1)), Plus(Var("x"), Const(2)))
+        with self.assertRaises(NoSolution):
+            exp.eval()
+
+    def test_bare_variable_on_both_sides(self):
+        for exp, value in [
+                (Equals(Minus(Times(Const(2), Var("x")), Const(3)), Var("x")),
+                 3),
+                (Equals(Var("x"), Minus(Times(Const(3), Var("x")), Const(4))),
+                 2)]:
+            with self.subTest(exp=str(exp)):
+                # Not an assignment, so it mustn't read x ...
+                ctx = Context()
+                self.assertEqual(exp.eval(ctx), Const(value))
+                self.assertEqual(ctx.lookup("x"), Const(value))
+                # ... or be thrown off by an old value of it
+                Var("x").assign(Const(10))
+                self.assertEqual(exp.eval(), Const(value))
+
+    def test_linear_form(self):
+        exp = Minus(Times(Const(4), Plus(Var("x"), Const(1))),
+                    Div(Var("x"), Const(2)))
+        self.assertEqual(linear_form(exp, "x"), (Fraction(7, 2), 4))
+        self.assertIsNone(linear_form(Times(Var("x"), Var("x")), "x"))
+        self.assertIsNone(linear_form(Plus(Var("x"), Var("y")), "x"))
+        self.assertIsNone(linear_form(Abs(Var("x")), "x"))
+        self.assertEqual(linear_form(Raise(Const(2), Const(3)), "x"), (0, 8))
+
+    def test_not_linear_falls_back(self):
+        # x appears once, so isolation handles it as before
+        exp = Equals(Raise(Var("x"), Const(2)), Const(9))
+        self.assertEqual(exp.eval(), Const(3.0))
+
+
+    def test_not_linear_on_both_sides(self):
+        x = Var("x")
+        for exp in [Equals(Times(x, x), Const(4)),
+                    Equals(Div(x, x), Const(1)),
+                    Equals(Times(Const(2), x), Times(x, x))]:
+            with self.subTest(exp=str(exp)):
+                # Whether or not x already has a value
+                for ctx in [Context(), Context({"x": Const(3)})]:
+                    with self.assertRaises(NotImplementedError):
+                        exp.eval(ctx)
+
+class TestSolutionCache(unittest.TestCase):
+
+    def setUp(self):
+        configure_solution_cache(capacity=2)
+
+    def test_not_mutated(self):
+        left = Plus(Times(Var("v"), Const(2)), Var("w"))
+        exp = Equals(left, Const(9))
+        Var("w").assign(Const(1))
+        self.assertEqual(exp.eval(), Const(4.0))
+        self.assertIs(exp.left, left)
+        self.assertEqual(exp.right, Const(9))
+
+    def test_reuse(self):
+        Var("w").assign(Const(1))
+        self.assertEqual(Equals(Plus(Var("v"), Var("w")), Const(9)).eval(),
+                         Const(8))
+        Var("w").assign(Const(5))
+        self.assertEqual(Equals(Plus(Var("v"), Var("w")), Const(9)).eval(),
+                         Const(4))
+        stats = expr.SOLUTION_CACHE.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_constant_types_kept_apart(self):
+        x_half = Div(Var("v"), Const(2))
+        self.assertEqual(Equals(x_half, Const(2.0)).eval(), Const(4.0))
+        result = Equals(x_half, Const(2)).eval()
+        self.assertIs(type(result.value), int)
+        self.assertEqual(result.value, 4)
+
+    def test_assignment_not_cached(self):
+        Equals(Var("v"), Const(1)).eval()
+        self.assertEqual(len(expr.SOLUTION_CACHE), 0)
+
+    def test_bounded(self):
+        for n in range(5):
+            Equals(Plus(Var("v"), Const(n)), Const(9)).eval()
+        self.assertEqual(len(expr.SOLUTION_CACHE), 2)
+        self.assertEqual(expr.SOLUTION_CACHE.stats()["evictions"], 3)
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_huge_power(self):
+        ctx = Context(budget=Budget())
+        exp = Raise(Const(9), Raise(Const(9), Const(9)))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(ctx)
+        with self.assertRaises(BudgetExceeded):
+            exp.eval_stack(ctx)
+        self.assertIsNone(ctx.meter)
+
+    def test_small_power_ok(self):
+        ctx = Context(budget=Budget())
+        self.assertEqual(Raise(Const(1), Const(10 ** 12)).eval(ctx), Const(1))
+        self.assertEqual(Raise(Const(2), Const(100)).eval(ctx),
+                         Const(2 ** 100))
+
+    def test_nodes(self):
+        exp = Const(1)
+        for _ in range(20):
+            exp = Plus(exp, Const(1))
+        self.assertEqual(exp.eval(Context(budget=Budget(max_nodes=41))),
+                         Const(21))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(Context(budget=Budget(max_nodes=40)))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(Context(budget=Budget(max_depth=20)))
+
+    def test_steps(self):
+        exp = Times(Plus(Const(1), Var("x")), Neg(Var("x")))
+        ctx = Context({"x": Const(2)}, budget=Budget(max_steps=2))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(ctx)
+
+    def test_time(self):
+        exp = Const(1)
+        for _ in range(300):
+            exp = Plus(exp, Const(1))
+        ctx = Context(budget=Budget(max_seconds=0))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(ctx)
+
+    def test_solve(self):
+        ctx = Context(budget=Budget(max_bits=100))
+        exp = Equals(Var("y"), Raise(Const(2), Const(200)))
+        with self.assertRaises(BudgetExceeded):
+            exp.eval(ctx)
+        self.assertNotIn("y", ctx.vars)
+
+    def test_no_budget(self):
+        exp = Raise(Const(2), Const(10000))
+        self.assertEqual(exp.eval(Context()), Const(2 ** 10000))
+
+
+class TestCompile(unittest.TestCase):
+
+    def test_const(self):
+        self.assertEqual(Const(5).compile()(), 5)
+
+    def test_matches_eval(self):
+        exp = Root(Abs(Neg(Plus(Times(Var("x"), Const(-3)),
+                                Div(Var("y"), Const(4))))),
+                   Raise(Const(2), Var("x")))
+        f = exp.compile()
+        for x, y in [(1, 2), (2, -7), (3, 0)]:
+            Var("x").assign(Const(x))
+            Var("y").assign(Const(y))
+            self.assertEqual(f(x=x, y=y), exp.eval().value)
+            self.assertEqual(f({"x": x, "y": y}), exp.eval().value)
+
+    def test_variables(self):
+        f = Minus(Var("b"), Times(Var("a"), Var("b"))).compile()
+        self.assertEqual(f.variables, ("b", "a"))
+        self.assertEqual(f(a=2, b=3), -3)
+
+    def test_undefined(self):
+        f = Plus(Var("x"), Const(1)).compile()
+        with self.assertRaises(UndefinedVariable):
+            f(y=1)
+
+    def test_equals(self):
+        with self.assertRaises(NotImplementedError):
+            Equals(Var("x"), Const(1)).compile()
+
+
+class TestEvalStack(unittest.TestCase):
+
+    def test_matches_eval(self):
+        Var("x").assign(Const(3))
+        exps = [Const(5),
+                Var("x"),
+                Minus(Const(7), Div(Times(Var("x"), Const(4)), Const(3))),
+                Root(Abs(Neg(Raise(Var("x"), Const(3)))), Const(2))]
+        for exp in exps:
+            with self.subTest(exp=exp):
+                self.assertEqual(exp.eval_stack(), exp.eval())
+
+    def test_solve(self):
+        exp = Equals(Minus(Const(2), Var("v")), Const(5))
+        self.assertEqual(exp.eval_stack(), Const(-3))
+        self.assertEqual(Var("v").eval(), Const(-3))
+
+    def test_deep(self):
+        exp = Const(1)
+        for _ in range(20000):
+            exp = Plus(exp, Const(1))
+        self.assertEqual(exp.eval_stack(), Const(20001))
+        self.assertEqual(exp.compile()(), 20001)
+        self.assertEqual(Equals(Var("y"), exp).eval_stack(), Const(20001))
+
+    def test_deep_solve(self):
+        exp = Var("y")
+        for _ in range(20000):
+            exp = Plus(exp, Const(1))
+        self.assertEqual(Equals(exp, Const(0)).eval_stack(), Const(-20000))
+
+    def test_postorder(self):
+        exp = Plus(Neg(Var("x")), Const(2))
+        self.assertEqual([repr(node) for node in exp.postorder()],
+                         ["Var(x)", "Neg(Var(x))", "Const(2)",
+                          "Plus(Neg(Var(x)), Const(2))"])
+
+
+class TestSharing(unittest.TestCase):
+
+    def test_interned_leaves(self):
+        self.assertIs(Const(7), Const(7))
+        self.assertIs(Var("q"), Var("q"))
+        self.assertIsNot(Const(7), Const(7.0))
+
+    def test_slots(self):
+        for node in [Const(1), Var("x"), Plus(Const(1), Const(2)),
+                     Neg(Const(1)), Equals(Var("x"), Const(1))]:
+            self.assertFalse(hasattr(node, "__dict__"))
+        self.assertEqual(Plus.op_sym, "+")
+        self.assertEqual(Abs(Const(1)).op_name, "Abs")
+
+    def test_structural_equality(self):
+        a = Times(Plus(Var("x"), Const(2)), Neg(Var("y")))
+        b = Times(Plus(Var("x"), Const(2)), Neg(Var("y")))
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(len({a, b}), 1)
+        self.assertNotEqual(a, Times(Plus(Var("x"), Const(3)), Neg(Var("y"))))
+        self.assertNotEqual(Plus(Const(1), Const(2)), Minus(Const(1), Const(2)))
+        self.assertEqual(Equals(a, Const(1)), Equals(b, Const(1)))
+
+    def test_deep_hash(self):
+        a, b = Const(0), Const(0)
+        for i in range(20000):
+            a, b = Plus(a, Var("x")), Plus(b, Var("x"))
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(a, b)
+
+    def test_pickle(self):
+        import pickle
+        exp = Equals(Plus(Var("x"), Const(2)), Abs(Const(-3)))
+        copy = pickle.loads(pickle.dumps(exp))
+        self.assertEqual(copy, exp)
+        self.assertIs(copy.right.left, Const(-3))
+
+    def test_abstract(self):
+        with self.assertRaises(NotImplementedError):
+            BinOp(Const(1), Const(2))
+        with self.assertRaises(NotImplementedError):
+            Unop(Const(1))
+
+
+class TestSimplify(unittest.TestCase):
+
+    def test_fold(self):
+        exp = Plus(Times(Const(2), Const(3)), Neg(Const(4)))
+        self.assertIs(simplify(exp), Const(2))
+        self.assertEqual(simplify(Root(Const(16), Const(2))), Const(4.0))
+
+    def test_huge_products_not_folded(self):
+        big = Const(3 ** 3000)
+        self.assertIsInstance(simplify(Times(big, big)), Times)
+        self.assertEqual(simplify(Times(Const(3 ** 30), Const(2))),
+                         Const(2 * 3 ** 30))
+
+    def test_partial_fold(self):
+        exp = Times(Var("x"), Minus(Const(5), Const(2)))
+        self.assertEqual(simplify(exp), Times(Var("x"), Const(3)))
+
+    def test_identities(self):
+        x = Var("x")
+        for exp in [Plus(x, Const(0)), Plus(Const(0), x), Minus(x, Const(0)),
+                    Times(x, Const(1)), Times(Const(1), x),
+                    Raise(x, Const(1)), Neg(Neg(x)),
+                    Plus(Times(Raise(x, Minus(Const(3), Const(2))),
+                               Const(1)), Times(Const(0), Const(5)))]:
+            with self.subTest(exp=exp):
+                self.assertIs(simplify(exp), x)
+
+    def test_keeps_types(self):
+        # x / 1 and x * 1.0 would turn an integer x into a float
+        for exp in [Div(Var("x"), Const(1)), Times(Var("x"), Const(1.0))]:
+            with self.subTest(exp=exp):
+                self.assertEqual(simplify(exp), exp)
+
+    def test_no_fold_errors(self):
+        exp = Div(Const(1), Minus(Const(2), Const(2)))
+        self.assertEqual(simplify(exp), Div(Const(1), Const(0)))
+        with self.assertRaises(ZeroDivisionError):
+            simplify(exp).eval()
+
+    def test_huge_power(self):
+        exp = Raise(Const(9), Raise(Const(9), Const(9)))
+        self.assertEqual(simplify(exp), Raise(Const(9), Const(387420489)))
+
+    def test_unchanged_is_shared(self):
+        exp = Plus(Var("x"), Var("y"))
+        self.assertIs(simplify(exp), exp)
+
+    def test_isolation_simplifies(self):
+        exp = Equals(Plus(Times(Var("v"), Const(2)), Const(3)), Const(9))
+        self.assertEqual(exp.eval(), Const(3.0))
+        self.assertEqual(exp.solved(), (Var("v"), Const(3.0)))
+
+
 if __name__ == "__main__":
     unittest.main()
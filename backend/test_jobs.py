@@ -0,0 +1,102 @@
+"""Test cases for jobs.py"""
+import threading
+import unittest
+import jobs
+from jobs import JobQueue, QueueFull
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.queues = []
+
+    def tearDown(self):
+        self.release.set()
+        for q in self.queues:
+            q.shutdown()
+
+    def make(self, work, **kwargs):
+        q = JobQueue(work, **kwargs)
+        self.queues.append(q)
+        return q
+
+    def blocked(self, key, value=None):
+        self.started.set()
+        self.release.wait(5)
+        return value
+
+    def test_runs_jobs(self):
+        q = self.make(lambda key, n: key * n, workers=3)
+        submitted = [q.submit(key, 2) for key in "abcde"]
+        for job in submitted:
+            self.assertTrue(job.wait(5))
+        self.assertEqual([job.result for job in submitted],
+                         ["aa", "bb", "cc", "dd", "ee"])
+        self.assertEqual(q.get("c").as_dict(),
+                         {"status": jobs.DONE, "result": "cc"})
+        self.assertIsNone(q.get("z"))
+
+    def test_status(self):
+        q = self.make(self.blocked, workers=1)
+        running = q.submit("a", 1)
+        waiting = q.submit("b", 2)
+        self.assertEqual(waiting.status, jobs.QUEUED)
+        self.release.set()
+        self.assertTrue(waiting.wait(5))
+        self.assertEqual((running.status, running.result), (jobs.DONE, 1))
+
+    def test_same_key_runs_once(self):
+        q = self.make(self.blocked, workers=1)
+        self.assertIs(q.submit("a"), q.submit("a"))
+        self.started.wait(5)
+        self.assertIs(q.get("a"), q.submit("a"))
+        self.assertEqual(q.get("a").status, jobs.RUNNING)
+
+    def test_backpressure(self):
+        q = self.make(self.blocked, workers=1, max_queued=2)
+        q.submit("running")
+        self.started.wait(5)
+        q.submit("b")
+        q.submit("c")
+        with self.assertRaises(QueueFull):
+            q.submit("d")
+        self.assertIsNone(q.get("d"))
+        self.release.set()
+        self.assertTrue(q.get("c").wait(5))
+        self.assertTrue(q.submit("d").wait(5))
+
+    def test_submit_many(self):
+        q = self.make(self.blocked, workers=1, max_queued=2)
+        q.submit("running")
+        self.started.wait(5)
+        q.submit("b")
+        with self.assertRaises(QueueFull):
+            q.submit_many([("c", ()), ("d", ())])
+        self.assertIsNone(q.get("c"))
+        # Jobs already queued or running take no more room
+        submitted = q.submit_many([("running", ()), ("b", ()), ("c", ())])
+        self.assertEqual([job.key for job in submitted],
+                         ["running", "b", "c"])
+        self.assertIs(submitted[1], q.get("b"))
+        self.release.set()
+        for job in submitted:
+            self.assertTrue(job.wait(5))
+
+    def test_failure(self):
+        def work(key):
+            raise ValueError("unreadable image")
+
+        q = self.make(work)
+        job = q.submit("a")
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.as_dict(), {
+            "status": jobs.FAILED,
+            "error": "ValueError: unreadable image"})
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNot(q.submit("a"), job)
+
+
+if __name__ == "__main__":
+    unittest.main()
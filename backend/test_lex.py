@@ -0,0 +1,108 @@
+"""Test cases for lex.py"""
+import io
+import unittest
+from lex import *
+
+
+def kinds_and_values(tokens):
+    return [(token.kind, token.value) for token in tokens]
+
+
+class TestLex(unittest.TestCase):
+
+    def test_simple(self):
+        tokens = lex("(3 * 5)/x")
+        self.assertEqual([token.value for token in tokens],
+                         ["(", "3", "*", "5", ")", "/", "x"])
+
+    def test_negative_int(self):
+        tokens = lex("5-3")
+        self.assertEqual(kinds_and_values(tokens),
+                         [(TokenCat.INT, "5"), (TokenCat.INT, "-3")])
+
+    def test_skips_comments(self):
+        tokens = lex("x = 4 # the answer")
+        self.assertEqual(len(tokens), 3)
+
+    def test_error(self):
+        with self.assertRaises(LexicalError):
+            lex("3 $ 4")
+
+
+class TestLexDifferential(unittest.TestCase):
+    """lex() must agree with the reference lexer token for token."""
+
+    CASES = [
+        "",
+        "   ",
+        "16 | 2",
+        "2 + 4 = x",
+        "(3 * 5)/x",
+        "5-3",
+        "5 - 3",
+        "~@x ^ -12 | y_z",
+        "a=b=c # comment (ignored)",
+        "((((1))))+-2--3",
+        "\tfoo\nbar  baz\n",
+    ]
+
+    def test_same_tokens(self):
+        for text in self.CASES:
+            with self.subTest(text=text):
+                self.assertEqual(kinds_and_values(lex(text)),
+                                 kinds_and_values(lex_reference(text)))
+
+    def test_same_errors(self):
+        for text in ["3 $ 4", "x = 'y'", "!"]:
+            with self.subTest(text=text):
+                with self.assertRaises(LexicalError) as fast:
+                    lex(text)
+                with self.assertRaises(LexicalError) as ref:
+                    lex_reference(text)
+                self.assertEqual(str(fast.exception), str(ref.exception))
+
+
+class TestTokenStream(unittest.TestCase):
+
+    def drain(self, stream):
+        tokens = []
+        while stream.has_more():
+            tokens.append(stream.take())
+        return tokens
+
+    def test_chunk_boundaries(self):
+        text = "12345 + x_y\n# comment\n  (y) -77 - 8 |  @~z\n"
+        expected = kinds_and_values(lex(text))
+        for size in range(1, 12):
+            with self.subTest(chunk_size=size):
+                stream = TokenStream(io.StringIO(text), chunk_size=size)
+                self.assertEqual(kinds_and_values(self.drain(stream)),
+                                 expected)
+
+    def test_lookahead(self):
+        stream = TokenStream(io.StringIO("a = b\n+ 1"))
+        self.assertEqual(stream.peek(2).value, "b")
+        self.assertEqual(stream.peek(3).value, "+")
+        self.assertEqual(stream.take().value, "a")
+        self.assertEqual(stream.peek().value, "=")
+        self.assertIs(stream.peek(10), END)
+
+    def test_end(self):
+        stream = TokenStream(io.StringIO("  # nothing here\n\n"))
+        self.assertFalse(stream.has_more())
+        self.assertIs(stream.take(), END)
+        self.assertIs(stream.peek(), END)
+
+    def test_from_tokens(self):
+        stream = TokenStream.from_tokens(lex("3 * 4"))
+        self.assertEqual([t.value for t in self.drain(stream)],
+                         ["3", "*", "4"])
+
+    def test_long_line(self):
+        text = " + ".join(["1"] * 20000)
+        stream = TokenStream(io.StringIO(text))
+        self.assertEqual(len(self.drain(stream)), 39999)
+
+
+if __name__ == "__main__":
+    unittest.main()
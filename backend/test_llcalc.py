@@ -0,0 +1,179 @@
+"""Test cases for llcalc.py"""
+import io
+import unittest
+import expr
+import llcalc
+
+
+class TestCalc(unittest.TestCase):
+
+    def setUp(self):
+        expr.env_clear()
+        llcalc.configure_parse_cache(capacity=4)
+
+    def test_calc(self):
+        self.assertEqual(llcalc.calc("2 + 4 = x"), "6")
+        self.assertEqual(llcalc.calc("16 | 2"), "4.0")
+
+    def test_calc_value_raises(self):
+        self.assertEqual(llcalc.calc_value("3 * 4"), "12")
+        with self.assertRaises(ZeroDivisionError):
+            llcalc.calc_value("1 / 0")
+        self.assertIsNone(llcalc.calc("1 / 0"))
+
+    def test_deep(self):
+        self.assertEqual(llcalc.calc("x" + " + 1" * 3000, expr.Context(
+            {"x": expr.Const(1)})), "3001")
+        self.assertEqual(llcalc.calc("y = 1" + " + x" * 3000, expr.Context(
+            {"x": expr.Const(2)})), "6001")
+
+    def test_budget_bounds_folding(self):
+        text = " * ".join(["99 ^ 99"] * 4000)
+        result = llcalc._calc_in(text, expr.Context(budget=expr.Budget()))
+        self.assertTrue(result.error.startswith("BudgetExceeded"))
+        # Small enough to parse, then folds only as far as it can
+        # cheaply; evaluating the rest is over the bit limit
+        text = " * ".join(["99 ^ 99"] * 100)
+        result = llcalc._calc_in(text, expr.Context(budget=expr.Budget()))
+        self.assertIn("bits", result.error)
+
+    def test_budget_allows_long_chains(self):
+        text = " + ".join(["1"] * 2000)
+        ctx = expr.Context(budget=expr.Budget())
+        self.assertEqual(llcalc.calc_value(text, ctx), "2000")
+
+
+class TestContext(unittest.TestCase):
+
+    def test_separate(self):
+        a, b = expr.Context(), expr.Context()
+        self.assertEqual(llcalc.calc("x = 2", a), "2")
+        self.assertEqual(llcalc.calc("x = 5", b), "5")
+        self.assertEqual(llcalc.calc("x * 10", a), "20")
+        self.assertEqual(llcalc.calc("2 * y = x + 1", b), "3.0")
+        self.assertNotIn("x", expr.ENV)
+        self.assertEqual(set(b.vars), {"x", "y"})
+
+    def test_default_is_global(self):
+        expr.env_clear()
+        llcalc.calc("z = 3")
+        self.assertEqual(expr.ENV["z"], expr.Const(3))
+        self.assertEqual(expr.Var("z").eval(expr.DEFAULT_CONTEXT),
+                         expr.Const(3))
+
+    def test_threads(self):
+        import threading
+        errors = []
+
+        def work(n):
+            ctx = expr.Context()
+            for i in range(200):
+                llcalc.calc(f"v = {n}", ctx)
+                if llcalc.calc("v + 0 * 1", ctx) != str(n):
+                    errors.append(n)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        expr.env_clear()
+        llcalc.configure_parse_cache(capacity=2)
+
+    def test_hits_after_normalising(self):
+        llcalc.calc("1 + 2")
+        llcalc.calc("  1   +  2 ")
+        stats = llcalc.parse_cache_stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+
+    def test_solving_does_not_corrupt_cache(self):
+        for _ in range(3):
+            self.assertEqual(llcalc.calc("x + 3 = 9"), "6")
+        self.assertEqual(llcalc.parse_cache_stats()["hits"], 2)
+
+    def test_eviction(self):
+        for text in ["1", "2", "3", "1"]:
+            llcalc.calc(text)
+        stats = llcalc.parse_cache_stats()
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["size"], 2)
+
+    def test_lru_order(self):
+        for text in ["1", "2", "1", "3", "1"]:
+            llcalc.calc(text)
+        stats = llcalc.parse_cache_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["evictions"], 1)
+
+    def test_fifo_order(self):
+        llcalc.configure_parse_cache(capacity=2, policy="fifo")
+        for text in ["1", "2", "1", "3", "1"]:
+            llcalc.calc(text)
+        self.assertEqual(llcalc.parse_cache_stats()["hits"], 1)
+
+    def test_disabled(self):
+        llcalc.configure_parse_cache(capacity=0)
+        llcalc.calc("1")
+        llcalc.calc("1")
+        self.assertEqual(llcalc.parse_cache_stats()["size"], 0)
+
+
+class TestCalcMany(unittest.TestCase):
+
+    TEXTS = ["1 + 2", "x = 5", "x * 2", "3 $ 4", "y + 1 = 4", "16 | 2"]
+
+    def check(self, results):
+        self.assertEqual([r.text for r in results], self.TEXTS)
+        self.assertEqual([r.value for r in results],
+                         ["3", "5", None, None, "3", "4.0"])
+        # Each text has its own environment, so x is undefined
+        self.assertIn("UndefinedVariable", results[2].error)
+        self.assertIn("LexicalError", results[3].error)
+
+    def test_in_process(self):
+        expr.env_clear()
+        results = list(llcalc.calc_many(self.TEXTS, workers=1, chunksize=4))
+        self.check(results)
+        self.assertEqual(expr.ENV, {})
+
+    def test_process_pool(self):
+        results = list(llcalc.calc_many(iter(self.TEXTS), workers=2,
+                                        chunksize=1))
+        self.check(results)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_run_batch(self):
+        infile = io.StringIO("x = 4\n\n# comment\n  x * 2 \n3 $ 4\n"
+                             "2 * y = x + 2\ny\n")
+        outfile = io.StringIO()
+        stats = llcalc.run_batch(infile, outfile)
+        self.assertEqual(outfile.getvalue().splitlines(),
+                         ["4", "8", "Error: LexicalError: Unrecognized "
+                          "character '$'", "3.0", "3.0"])
+        self.assertEqual((stats.statements, stats.errors), (5, 1))
+
+    def test_main(self):
+        import contextlib
+        import tempfile
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("a = 2\na ^ 10\n")
+            f.flush()
+            out, err = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(out), \
+                    contextlib.redirect_stderr(err):
+                llcalc.main([f.name])
+        self.assertEqual(out.getvalue(), "2\n1024\n")
+        self.assertIn("2 statements, 0 errors", err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
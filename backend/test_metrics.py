@@ -0,0 +1,65 @@
+"""Test cases for metrics.py"""
+import unittest
+import llcalc
+import metrics
+from metrics import Counter, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        c = Counter("test_things_total", "Things", labels=("kind",))
+        c.inc(kind="a")
+        c.inc(2, kind="a")
+        c.inc(kind='say "hi"')
+        self.assertEqual(c.value(kind="a"), 3)
+        text = metrics.render()
+        self.assertIn("# TYPE test_things_total counter", text)
+        self.assertIn('test_things_total{kind="a"} 3', text)
+        self.assertIn('test_things_total{kind="say \\"hi\\""} 1', text)
+        with self.assertRaises(ValueError):
+            c.inc(colour="red")
+
+    def test_histogram(self):
+        h = Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1))
+        for value in [0.05, 0.5, 0.5, 3]:
+            h.observe(value)
+        lines = h.render()
+        self.assertEqual(lines[2:], [
+            'test_latency_seconds_bucket{le="0.1"} 1',
+            'test_latency_seconds_bucket{le="1"} 3',
+            'test_latency_seconds_bucket{le="+Inf"} 4',
+            'test_latency_seconds_sum 4.05',
+            'test_latency_seconds_count 4'])
+
+    def test_stage(self):
+        before = metrics.ERRORS.value(stage="test", error="KeyError")
+        with self.assertRaises(KeyError):
+            with metrics.stage("test"):
+                {}["x"]
+        with metrics.stage("test"):
+            pass
+        self.assertEqual(metrics.STAGE_SECONDS.count(stage="test"), 2)
+        self.assertEqual(metrics.ERRORS.value(stage="test", error="KeyError"),
+                         before + 1)
+
+    def test_calculator(self):
+        llcalc.configure_parse_cache()
+        counts = {stage: metrics.STAGE_SECONDS.count(stage=stage)
+                  for stage in ["lex", "parse", "eval"]}
+        llcalc.calc("17 * 3")
+        llcalc.calc("17 * 3")
+        llcalc.calc("1 / 0")
+        self.assertEqual(metrics.STAGE_SECONDS.count(stage="lex"),
+                         counts["lex"] + 2)
+        self.assertEqual(metrics.STAGE_SECONDS.count(stage="eval"),
+                         counts["eval"] + 3)
+        self.assertGreaterEqual(
+            metrics.ERRORS.value(stage="eval", error="ZeroDivisionError"), 1)
+        text = metrics.render()
+        self.assertIn('cache_hits_total{cache="parse"} 1', text)
+        self.assertIn('cache_size{cache="solution"}', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Test cases for resultcache.py"""
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import resultcache
+from lru import MISSING
+from resultcache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def compute(self, value="42"):
+        def f():
+            self.calls += 1
+            return value
+        return f
+
+    def test_computes_once(self):
+        cache = ResultCache()
+        self.assertEqual(cache.get("abc", self.compute()), "42")
+        self.assertEqual(cache.get("abc", self.compute()), "42")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_invalidate(self):
+        cache = ResultCache()
+        cache.get("abc", self.compute("1"))
+        cache.invalidate("abc")
+        self.assertEqual(cache.get("abc", self.compute("2")), "2")
+
+    def test_coalesces(self):
+        cache = ResultCache()
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            time.sleep(0.1)
+            self.calls += 1
+            return "slow"
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get("abc", slow)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["slow"] * 8)
+        self.assertEqual(self.calls, 1)
+
+    def test_errors_not_cached(self):
+        cache = ResultCache()
+
+        def fail():
+            raise ValueError("bad image")
+
+        with self.assertRaises(ValueError):
+            cache.get("abc", fail)
+        self.assertEqual(cache.get("abc", self.compute()), "42")
+
+    def test_invalidated_while_computing(self):
+        cache = ResultCache()
+
+        def replaced():
+            cache.invalidate("abc")
+            return "old"
+
+        self.assertEqual(cache.get("abc", replaced), "old")
+        self.assertEqual(cache.get("abc", self.compute("new")), "new")
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ResultCache(directory=directory).get("abc", self.compute())
+            restarted = ResultCache(directory=directory)
+            self.assertEqual(restarted.get("abc", self.compute()), "42")
+            self.assertEqual(self.calls, 1)
+            restarted.invalidate("abc")
+            ResultCache(directory=directory).get("abc", self.compute())
+            self.assertEqual(self.calls, 2)
+
+    def test_writes_outside_lock(self):
+        writing = threading.Event()
+        release = threading.Event()
+        dump = resultcache.json.dump
+
+        def slow_dump(obj, f):
+            if obj["result"] == "slow":
+                writing.set()
+                release.wait(5)
+            dump(obj, f)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(resultcache.json, "dump", slow_dump):
+            cache = ResultCache(directory=directory)
+            thread = threading.Thread(
+                target=cache.get, args=("abc", self.compute("slow")))
+            thread.start()
+            self.assertTrue(writing.wait(5))
+            # Other keys don't wait for the write ...
+            other = threading.Thread(
+                target=cache.get, args=("def", self.compute()))
+            other.start()
+            other.join(1)
+            self.assertFalse(other.is_alive())
+            # ... and invalidating this one stops it being kept
+            cache.invalidate("abc")
+            release.set()
+            thread.join(5)
+            self.assertIs(cache.lookup("abc"), MISSING)
+            self.assertIs(ResultCache(directory=directory).lookup("abc"),
+                          MISSING)
+
+    def test_unsafe_keys_stay_in_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory=directory)
+            cache.get("../abc", self.compute())
+            self.assertIsNone(cache._path("../abc"))
+            self.assertEqual(cache.get("../abc", self.compute()), "42")
+            self.assertEqual(self.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
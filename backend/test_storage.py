@@ -0,0 +1,81 @@
+"""Test cases for storage.py"""
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+import storage
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.tmp.name, "uploads")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_content_addressed(self):
+        data = os.urandom(3 * storage.CHUNK_SIZE + 17)
+        stored = storage.save(io.BytesIO(data), self.folder)
+        self.assertEqual(stored.key,
+                         hashlib.sha256(data).hexdigest()[:storage.HASH_LENGTH])
+        self.assertEqual(stored.size, len(data))
+        self.assertFalse(stored.duplicate)
+        with open(stored.path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_duplicates(self):
+        first = storage.save(io.BytesIO(b"worksheet"), self.folder)
+        again = storage.save(io.BytesIO(b"worksheet"), self.folder)
+        other = storage.save(io.BytesIO(b"another one"), self.folder)
+        self.assertTrue(again.duplicate)
+        self.assertEqual(again.key, first.key)
+        self.assertNotEqual(other.key, first.key)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         sorted([first.key, other.key]))
+
+    def test_failed_read_leaves_nothing(self):
+        class Broken(io.BytesIO):
+            def read(self, size=-1):
+                raise IOError("connection reset")
+
+        with self.assertRaises(IOError):
+            storage.save(Broken(), self.folder)
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_max_size(self):
+        data = b"x" * (2 * storage.CHUNK_SIZE)
+        stored = storage.save(io.BytesIO(data), self.folder,
+                              max_size=len(data))
+        self.assertEqual(stored.size, len(data))
+        with self.assertRaises(storage.TooLarge):
+            storage.save(io.BytesIO(data + b"y"), self.folder,
+                         max_size=len(data))
+        self.assertEqual(os.listdir(self.folder), [stored.key])
+
+    def test_stops_reading_when_too_large(self):
+        class Endless(object):
+            reads = 0
+
+            def read(self, size):
+                self.reads += 1
+                return b"\0" * size
+
+        stream = Endless()
+        with self.assertRaises(storage.TooLarge):
+            storage.save(stream, self.folder, max_size=storage.CHUNK_SIZE)
+        self.assertEqual(stream.reads, 2)
+
+    def test_lookup(self):
+        stored = storage.save(io.BytesIO(b"x"), self.folder)
+        self.assertEqual(storage.lookup(self.folder, stored.key), stored.path)
+        self.assertIsNone(storage.lookup(self.folder, "0" * 15))
+        for bad in ["../" + stored.key[3:], stored.key.upper(), "metrics"]:
+            with self.subTest(key=bad):
+                self.assertIsNone(storage.lookup(self.folder, bad))
+
+
+if __name__ == "__main__":
+    unittest.main()
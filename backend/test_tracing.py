@@ -0,0 +1,59 @@
+"""Test cases for tracing.py"""
+import threading
+import unittest
+import expr
+import llcalc
+import tracing
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        expr.env_clear()
+        expr.Var("y").assign(expr.Const(9))
+        llcalc.configure_parse_cache(capacity=0)
+
+    def test_off_by_default(self):
+        self.assertFalse(tracing.ENABLED)
+
+    def test_stages(self):
+        with tracing.capture() as events:
+            self.assertTrue(tracing.ENABLED)
+            llcalc.calc("x * 3 = y * 2")
+        self.assertFalse(tracing.ENABLED)
+        stages = {event.stage for event in events}
+        self.assertEqual(stages, {"calc", "lex", "parse", "solve", "eval"})
+
+    def test_nested(self):
+        with tracing.capture() as outer:
+            with tracing.capture() as inner:
+                llcalc.calc("y + 2")
+            llcalc.calc("3")
+        self.assertIn("Plus", [event.event for event in inner])
+        self.assertNotIn("Plus", [event.event for event in outer])
+        self.assertTrue(outer)
+
+    def test_other_threads_not_captured(self):
+        with tracing.capture() as events:
+            thread = threading.Thread(target=llcalc.calc, args=("y + 2",))
+            thread.start()
+            thread.join()
+        self.assertEqual(events, [])
+
+    def test_as_dict(self):
+        with tracing.capture() as events:
+            llcalc.calc("y + 2")
+        last = events[-1].as_dict()
+        self.assertEqual(last["stage"], "eval")
+        self.assertEqual(last["fields"]["result"], "11")
+
+    def test_variables(self):
+        expr.Var("y").assign(expr.Const(4))
+        with tracing.capture() as events:
+            self.assertEqual(llcalc.calc("y + 1"), "5")
+        reads = [event for event in events if event.event == "Var"]
+        self.assertEqual(reads[0].fields["var"], "y")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Test cases for vector.py"""
+import math
+import unittest
+import warnings
+from expr import *
+
+try:
+    import numpy as np
+    import vector
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestVector(unittest.TestCase):
+
+    def test_matches_eval(self):
+        exp = Plus(Raise(Var("x"), Const(2)), Times(Const(3), Var("x")))
+        xs = np.arange(-5, 6)
+        result = vector.eval_array(exp, x=xs)
+        for x, value in zip(xs, result):
+            Var("x").assign(Const(int(x)))
+            self.assertEqual(value, exp.eval().value)
+
+    def test_div_by_zero(self):
+        exp = Div(Const(1), Var("x"))
+        result = vector.eval_array(exp, x=[-0.5, 0, 2])
+        self.assertEqual(list(result), [-2, math.inf, 0.5])
+        self.assertTrue(np.isnan(vector.eval_array(
+            Div(Var("x"), Var("x")), x=[0])[0]))
+
+    def test_negative_root(self):
+        result = vector.eval_array(Root(Var("x"), Const(2)), x=[-4, 9])
+        self.assertTrue(np.isnan(result[0]))
+        self.assertEqual(result[1], 3)
+
+    def test_constant_subtrees(self):
+        x = [1, 2, 3]
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            for exp, expected in [
+                    (Div(Const(1), Minus(Const(2), Const(2))), math.inf),
+                    (Raise(Const(10), Const(400)), math.inf),
+                    (Times(Const(-1), Raise(Const(10), Const(400))),
+                     -math.inf),
+                    (Root(Minus(Const(0), Const(8)), Const(3)), math.nan)]:
+                with self.subTest(exp=exp):
+                    result = vector.eval_array(Plus(Var("x"), exp), x=x)
+                    np.testing.assert_array_equal(result, [expected] * 3)
+
+    def test_writable(self):
+        for exp in [Plus(Var("x"), Const(1)), Const(1)]:
+            with self.subTest(exp=exp):
+                result = vector.eval_array(exp, x=[1, 2])
+                result[...] = 0
+                self.assertFalse(result.any())
+
+    def test_broadcast(self):
+        result = vector.eval_array(Times(Var("x"), Var("y")),
+                                   x=[[1], [2]], y=[1, 2, 3])
+        self.assertEqual(result.shape, (2, 3))
+        self.assertEqual(vector.eval_array(Neg(Const(2)), x=[1, 2]).shape,
+                         ())
+
+    def test_unary(self):
+        result = vector.vectorize(Abs(Neg(Var("x"))))({"x": [-1, 2]})
+        self.assertEqual(list(result), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
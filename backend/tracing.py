@@ -0,0 +1,112 @@
+"""
+Tracing for the lexer, parser and evaluator.
+
+Each stage reports what it is doing as structured TraceEvents
+(stage, event name, and keyword fields).  Trace points are
+written
+    if tracing.ENABLED:
+        tracing.event("parse", "primary", token=stream.peek())
+so when tracing is off they cost one global lookup, and no
+strings are formatted and nothing is written anywhere.
+
+Tracing is turned on in two ways:
+  * For the whole process, by setting the environment variable
+    CALC_TRACE=1 (or calling enable()).  Events are then logged
+    to the "tracing" logger, which writes to the file named by
+    CALC_TRACE_FILE if it is set, else to stderr.
+  * For one piece of work in the current thread, with
+        with tracing.capture() as events:
+            calc("2 + 4 = x")
+    which collects that thread's events in the list events.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+log.propagate = False
+
+
+class TraceEvent(NamedTuple):
+    """One step of the lexer, parser or evaluator"""
+    stage: str
+    event: str
+    fields: Dict[str, Any]
+    time: float
+
+    def as_dict(self) -> Dict[str, Any]:
+        """The event as JSON-friendly values"""
+        return {"stage": self.stage, "event": self.event,
+                "time": self.time,
+                "fields": {k: str(v) for k, v in self.fields.items()}}
+
+    def __str__(self) -> str:
+        fields = " ".join(f"{k}={v}" for k, v in self.fields.items())
+        return f"[{self.stage}] {self.event} {fields}"
+
+
+# True whenever anyone is collecting events.  Read directly by
+# every trace point, so keep it a plain module global.
+ENABLED = False
+
+_logging = False
+_captures = 0
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _update():
+    global ENABLED
+    ENABLED = _logging or _captures > 0
+
+
+def enable(on: bool = True):
+    """Turn logging of every event in the process on or off"""
+    global _logging
+    with _lock:
+        if on and not log.handlers:
+            path = os.environ.get("CALC_TRACE_FILE")
+            log.addHandler(logging.FileHandler(path) if path
+                           else logging.StreamHandler())
+        _logging = on
+        _update()
+
+
+@contextmanager
+def capture() -> Iterator[List[TraceEvent]]:
+    """Collect the events of the current thread while the
+    with block runs.  Captures may be nested; the innermost
+    one gets the events.
+    """
+    global _captures
+    events = []
+    outer = getattr(_local, "events", None)
+    _local.events = events
+    with _lock:
+        _captures += 1
+        _update()
+    try:
+        yield events
+    finally:
+        _local.events = outer
+        with _lock:
+            _captures -= 1
+            _update()
+
+
+def event(stage: str, name: str, **fields: Any):
+    """Record an event.  Call only when ENABLED is true."""
+    ev = TraceEvent(stage, name, fields, time.perf_counter())
+    events = getattr(_local, "events", None)
+    if events is not None:
+        events.append(ev)
+    if _logging:
+        log.debug("%s", ev)
+
+
+if os.environ.get("CALC_TRACE", "") not in ("", "0"):
+    enable()
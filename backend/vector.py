@@ -0,0 +1,64 @@
+"""
+Vectorised evaluation of expressions with NumPy.
+
+Evaluates one expression for many values of its variables at
+once: each variable is bound to an array, and each operator in
+the tree is applied once to whole arrays rather than once per
+point.  The expression is compiled with Expr.compile, so the
+same code runs on arrays that eval() would run on numbers.
+
+Semantics differ from eval() where arrays need them to:
+  * Values are float64, so integer results come back as floats.
+  * Division by zero gives inf or -inf (nan for 0 / 0), and
+    results too large for a float give inf.
+  * A root of a negative number (including raising to a
+    fractional power) gives nan rather than a complex number.
+No warnings are issued for any of these.
+"""
+import math
+from typing import Callable
+
+import numpy as np
+
+import expr
+
+
+def vectorize(exp: expr.Expr) -> Callable[..., np.ndarray]:
+    """A function evaluating exp over arrays of bindings, e.g.
+        f = vectorize(parse(io.StringIO("x ^ 2 + 3 * x")))
+        f(x=np.arange(100000))
+    Variables may be bound to arrays, sequences or scalars of
+    any shapes that broadcast together; the result has the
+    broadcast shape.
+    """
+    # Constants are float64 too, so that constant subtrees get
+    # the same semantics as everything else
+    compiled = exp.compile(_float)
+
+    def evaluate(*args, **bindings) -> np.ndarray:
+        env = args[0] if args else bindings
+        arrays = {name: np.asarray(env[name], dtype=np.float64)
+                  for name in compiled.variables if name in env}
+        shape = np.broadcast(*arrays.values()).shape if arrays else ()
+        with np.errstate(divide="ignore", invalid="ignore",
+                         over="ignore"):
+            result = compiled(arrays)
+        # A constant expression computes a scalar; give it the
+        # shape of the inputs.
+        return np.array(np.broadcast_to(result, shape), dtype=np.float64)
+
+    evaluate.variables = compiled.variables
+    return evaluate
+
+
+def _float(value) -> np.float64:
+    """value as a float64, or inf if it is too large for one"""
+    try:
+        return np.float64(value)
+    except OverflowError:
+        return np.float64(math.copysign(math.inf, value))
+
+
+def eval_array(exp: expr.Expr, *args, **bindings) -> np.ndarray:
+    """Evaluate exp once over arrays of variable values."""
+    return vectorize(exp)(*args, **bindings)
@@ -37,16 +37,25 @@ const ApiMessenger = () => {
     }
 
     useEffect(() => {
-      setTimeout(() => {  
+      // The result is computed in the background; the server
+      // answers 202 until it is ready, so ask again until then.
+      let timer: ReturnType<typeof setTimeout>;
+      const poll = () => {
         console.log(hash);
         axios.get('http://0.0.0.0:3000/' + hash)
         .then(response => {
             console.log(response);
-            setOutput(response.data);
+            if (response.status === 202) {
+                timer = setTimeout(poll, 1000);
+            } else {
+                setOutput(response.data);
+            }
         }, error => {
             console.log(error);
         });
-      }, 1000);
+      };
+      timer = setTimeout(poll, 1000);
+      return () => clearTimeout(timer);
     }, [hash])
 
     return (